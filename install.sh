@@ -170,12 +170,14 @@ After=network.target mosquitto.service zigbee2mqtt.service
 [Service]
 Type=notify
 ExecStart=python3 main.py thermostat.yaml 
+ExecReload=/bin/kill -HUP \$MAINPID
 WorkingDirectory=/opt/zigbee-thermostat-connector
 StandardOutput=inherit
 StandardError=inherit
 WatchdogSec=10s
 Restart=always
 RestartSec=10s
+StateDirectory=zigbee-thermostat-connector
 
 [Install]
 WantedBy=multi-user.target
@@ -2,214 +2,865 @@
 
 # Loosely based off Home Assistant's generic thermostat
 # https://github.com/home-assistant/core/tree/dev/homeassistant/components/generic_thermostat
+import time
+# Taken before the other imports, for --profile-startup
+IMPORTS_STARTED = time.perf_counter()
+import argparse
 import yaml
 import logging
+import logging.handlers
+import queue
 import sys
-import time
+import math
+from collections import deque
+import heapq
+import itertools
+from array import array
+from bisect import bisect_left
+from datetime import date
+from setpoints import SetpointSchedule
 import gpiod
 import platform
 from gpiod.line import Direction, Value, Bias
-from gevent.pywsgi import WSGIServer
-from flask import Flask, request, jsonify, Response
-from flask_classful import FlaskView, route
-import paho.mqtt.client as paho
+import gevent.event
+import gevent.queue
+import gevent.select
+# Imported by MQTTBridge, once control is already running
+paho = None
 import json
+try:
+    # Optional, several times faster at decoding zigbee2mqtt payloads
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+import os
+import random
+import signal
+import struct
+import zlib
 import gevent
 from systemd.daemon import notify
 
 MODE_HEAT = "HEAT"
 MODE_COOL = "COOL"
 MODE_OFF = "OFF"
+MODE_DRAINING = "DRAINING"
 
 MODE_OPEN = 1
 MODE_CLOSED = 0
 
-GPIOCHIP = None
-GPIOREVERSE = False
-
-def set_gpio_state(gpio, state):
-    if GPIOCHIP:
-        line = GPIOCHIP.line_offset_from_id(gpio)
-        request = GPIOCHIP.request_lines(config={  
-            line: gpiod.LineSettings(
-                direction=Direction.OUTPUT,
-                active_low=GPIOREVERSE,
-                bias=Bias.PULL_UP if GPIOREVERSE else Bias.PULL_DOWN,
-            )
-        })
-        request.set_value(line, Value.ACTIVE if state else Value.INACTIVE)
+# What a room without recent temperature readings falls back to
+STALE_CLOSE = "close"
+STALE_OFF_TEMPERATURE = "off_temperature"
+
+# Compact encoding of modes in the history buffers and state snapshots
+MODE_CODES = [MODE_OFF, MODE_HEAT, MODE_COOL]
+
+# Monotonic time source of the control logic, the simulator swaps in virtual time
+clock = time.monotonic
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval, max_keys=1024):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        # (message template, args) -> [last emitted, suppressed since]
+        self.seen = {}
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+        try:
+            key = (record.levelno, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            return True
+
+        now = time.monotonic()
+        entry = self.seen.get(key)
+        if entry is not None and (now - entry[0]) < self.interval:
+            entry[1] += 1
+            return False
+
+        if entry is not None and entry[1]:
+            record.suppressed = entry[1]
+        if len(self.seen) >= self.max_keys:
+            self.seen = {k: v for k, v in self.seen.items() if (now - v[0]) < self.interval}
+        self.seen[key] = [now, 0]
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock handler formats the message here, on the caller's side. Leave it
+        # to the worker instead, our log arguments are plain values.
+        return record
+
+class SuppressedFormatter(logging.Formatter):
+    def format(self, record):
+        msg = super().format(record)
+        if getattr(record, "suppressed", 0):
+            msg = "%s (repeated %d times)" % (msg, record.suppressed)
+        return msg
 
-    else:
-        print(f"Setting {gpio} to {state}")
+def setup_logging(config):
+    level = logging.getLevelName(str(config.get("level", "INFO")).upper())
+    handler = logging.StreamHandler()
+    handler.setFormatter(SuppressedFormatter(config.get("format", "%(levelname)s:%(name)s:%(message)s")))
+
+    # Records are handed over to a background worker which does the formatting and writing
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(float(config.get("rate_limit_interval", 10))))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [queue_handler]
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+class Counter:
+    def __init__(self, label_names=(), label_values=()):
+        self.label_names = label_names
+        self.label_values = label_values
+        self.value = 0
+        self.children = {}
+
+    def labels(self, *values):
+        # Children are created once per label set. Hot paths keep the child they got here
+        # instead of looking it up for every observation
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Counter(self.label_names, values)
+        return child
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        if not self.label_names:
+            yield name, (), self.value
+        for child in self.children.values():
+            yield name, zip(child.label_names, child.label_values), child.value
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        # One extra slot for +Inf
+        self.counts = array("Q", bytes(8 * (len(self.buckets) + 1)))
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f"{name}_bucket", (("le", repr(float(bound))),), total
+        total += self.counts[-1]
+        yield f"{name}_bucket", (("le", "+Inf"),), total
+        yield f"{name}_sum", (), self.sum
+        yield f"{name}_count", (), total
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, *label_names):
+        metric = Counter(label_names)
+        self.metrics.append((name, help_text, "counter", metric))
+        return metric
+
+    def histogram(self, name, help_text, buckets):
+        metric = Histogram(buckets)
+        self.metrics.append((name, help_text, "histogram", metric))
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for name, help_text, metric_type, metric in self.metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample_name, labels, value in metric.samples(name):
+                label_str = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+                if label_str:
+                    lines.append(f"{sample_name}{{{label_str}}} {value}")
+                else:
+                    lines.append(f"{sample_name} {value}")
+        lines.append("")
+        return "\n".join(lines)
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+METRICS = MetricsRegistry()
+MQTT_RECEIVED = METRICS.counter("thermostat_mqtt_messages_received_total", "MQTT messages received", "topic")
+MQTT_DECODED = METRICS.counter("thermostat_mqtt_messages_decoded_total", "MQTT messages decoded and dispatched to thermostats", "topic")
+MQTT_DROPPED = METRICS.counter("thermostat_mqtt_messages_dropped_total", "MQTT messages ignored or failed to process", "topic")
+MQTT_SKIPPED = METRICS.counter("thermostat_mqtt_messages_skipped_total", "MQTT messages skipped without decoding (repeated or without mapped fields)", "topic")
+MQTT_HANDLING_SECONDS = METRICS.histogram("thermostat_mqtt_message_handling_seconds", "Time spent handling one MQTT message", LATENCY_BUCKETS)
+MQTT_PUBLISHED = METRICS.counter("thermostat_mqtt_published_messages_total", "MQTT messages published", "kind")
+MQTT_PUBLISHED_BYTES = METRICS.counter("thermostat_mqtt_published_bytes_total", "MQTT payload bytes published", "kind")
+MQTT_OUTBOX_DROPPED = METRICS.counter("thermostat_mqtt_outbox_dropped_total", "Messages dropped from a full offline outbox", "kind")
+MQTT_CONNECTS = METRICS.counter("thermostat_mqtt_connect_attempts_total", "Attempts to connect to the MQTT server", "result")
+CONTROL_TICK_SECONDS = METRICS.histogram("thermostat_control_tick_seconds", "Duration of a control evaluation", LATENCY_BUCKETS)
+INPUT_TO_RELAY_SECONDS = METRICS.histogram("thermostat_input_to_relay_seconds", "Time from a changed sensor or setpoint input to the relays switching", LATENCY_BUCKETS)
+RELAY_SWITCHES = METRICS.counter("thermostat_relay_switches_total", "Relay state changes", "gpio")
+SENSOR_STALE = METRICS.counter("thermostat_sensor_stale_total", "Times a room stopped getting temperature readings and fell back to its safe mode", "room")
+VALVE_DEFERRALS = METRICS.counter("thermostat_valve_deferrals_total", "Valve changes postponed by the relay planner", "reason")
+CHANGEOVER_SECONDS = METRICS.histogram("thermostat_changeover_seconds", "Time spent with both mode relays off during a changeover", (0.5, 1, 2, 5, 10, 30, 60))
+HUB_LAG_SECONDS = METRICS.histogram("thermostat_event_loop_lag_seconds", "How late the gevent hub woke up the watchdog greenlet", LATENCY_BUCKETS)
+
+class RelayBank:
+    def __init__(self, logger, chip, gpios, reverse=False, initial=None):
+        self.logger = logger
+        self.chip = chip
+        self.reverse = reverse
+
+        self.offsets = {}
+        # gpio -> line request holding it, lines requested together share one
+        self.requests = {}
+        self.states = {}
+        self.pending = {}
+        # gpio -> its switch counter
+        self.switch_counters = {}
+        # gpio -> (request, offset) of lines a reload dropped, the kernel keeps them held as
+        # long as their request has other lines in use, so they are reused from here
+        self.held = {}
+
+        # Resolve and request all relay lines once, the handles are kept open for the
+        # lifetime of the process (or until a config reload drops them)
+        self.add_lines(gpios, initial)
+
+    def add_lines(self, gpios, initial=None):
+        new_gpios = []
+        for gpio in gpios:
+            if gpio not in self.states and gpio not in new_gpios:
+                new_gpios.append(gpio)
+        if not new_gpios:
+            return
+
+        states = {}
+        for gpio in new_gpios:
+            states[gpio] = bool(initial.get(gpio, False)) if initial else False
+
+        for gpio in [gpio for gpio in new_gpios if gpio in self.held]:
+            request, offset = self.held.pop(gpio)
+            request.set_values({offset: Value.ACTIVE if states[gpio] else Value.INACTIVE})
+            self.requests[gpio] = request
+            self.offsets[gpio] = offset
+        requested = [gpio for gpio in new_gpios if gpio not in self.requests]
+
+        if self.chip and requested:
+            offsets = {gpio: self.chip.line_offset_from_id(gpio) for gpio in requested}
+            request = self.chip.request_lines(
+                consumer="zigbee-thermostat-connector",
+                config={
+                    tuple(set(offsets.values())): gpiod.LineSettings(
+                        direction=Direction.OUTPUT,
+                        active_low=self.reverse,
+                        bias=Bias.PULL_UP if self.reverse else Bias.PULL_DOWN,
+                    )
+                },
+                # Lines come up in their restored state so a restart does not toggle them
+                output_values={
+                    offsets[gpio]: Value.ACTIVE if state else Value.INACTIVE
+                    for gpio, state in states.items()
+                },
+            )
+            self.offsets.update(offsets)
+            for gpio in requested:
+                self.requests[gpio] = request
+        for gpio in new_gpios:
+            self.switch_counters[gpio] = RELAY_SWITCHES.labels(gpio)
+        self.states.update(states)
+
+    def remove_lines(self, gpios):
+        for gpio in gpios:
+            if gpio not in self.states:
+                continue
+            del self.states[gpio]
+            self.pending.pop(gpio, None)
+            self.switch_counters.pop(gpio, None)
+            offset = self.offsets.pop(gpio, None)
+            request = self.requests.pop(gpio, None)
+            if request is None:
+                continue
+            if any(r is request for r in self.requests.values()):
+                self.held[gpio] = (request, offset)
+            else:
+                # The request is released once none of its lines are in use any more
+                request.release()
+                self.held = {gpio: held for gpio, held in self.held.items() if held[0] is not request}
+
+    def set(self, gpio, state):
+        self.pending[gpio] = bool(state)
+
+    def commit(self):
+        changes = {}
+        for gpio, state in self.pending.items():
+            if self.states[gpio] != state:
+                changes[gpio] = state
+        self.pending.clear()
+        if not changes:
+            return 0
+
+        if self.chip:
+            # One write per line request, normally there is just the one
+            writes = {}
+            for gpio, state in changes.items():
+                request = self.requests[gpio]
+                values = writes.setdefault(id(request), (request, {}))[1]
+                values[self.offsets[gpio]] = Value.ACTIVE if state else Value.INACTIVE
+            for request, values in writes.values():
+                request.set_values(values)
+        else:
+            for gpio, state in changes.items():
+                self.logger.info("Setting %s to %s", gpio, state)
+        self.states.update(changes)
+        for gpio in changes:
+            self.switch_counters[gpio].inc()
+        return len(changes)
+
+    def close(self):
+        released = []
+        for request in self.requests.values():
+            if not any(r is request for r in released):
+                request.release()
+                released.append(request)
+        self.requests = {}
 
 class Display:
+    row_height = 10
 
-    def __init__(self, control_unit, thermostats):
+    def __init__(self, logger, control_unit, thermostats, config):
+        self.logger = logger
         self._control_unit = control_unit
         self._thermostats = thermostats
 
-        self.lines = ["", "Starting up...", "", ""]
+        self.config = config
+        self.fps = float(config.get("fps", 2))
+        # Rooms are paged through when they do not fit on the panel
+        self.page_interval = float(config.get("page_interval", 5))
+        self.device = self.create_device(config)
+
+        self.rows = self.device.height // self.row_height
+        self.lines = ["Starting up..."] + [""] * (self.rows - 1)
+        # What is currently on the panel, one entry per text row
+        self.drawn = [None] * self.rows
+        self.page = 0
+        self.page_started = clock()
+
+        from PIL import Image, ImageDraw, ImageFont
+        self.image = Image.new(self.device.mode, self.device.size)
+        self.draw = ImageDraw.Draw(self.image)
+        self.font = ImageFont.load_default()
+
+        # Shown until the first frame is composed from the control state
+        self.render()
+
+        self.changed = gevent.event.Event()
+        self.changed.set()
+
+    @staticmethod
+    def create_device(config):
+        # Imported here so the hardware libraries are only needed with a display configured
+        from luma.core.framebuffer import diff_to_previous
+
+        width = int(config.get("width", 128))
+        height = int(config.get("height", 64))
+        rotate = int(config.get("rotate", 0))
+        driver = config.get("driver", "ssd1306")
+        if driver == "dummy":
+            from luma.core.device import dummy
+            return dummy(width=width, height=height, rotate=rotate, mode="1")
+
+        from luma.core.interface.serial import i2c, spi
+        import luma.oled.device
+        if config.get("interface", "i2c") == "spi":
+            serial = spi(port=int(config.get("port", 0)), device=int(config.get("device", 0)))
+        else:
+            serial = i2c(port=int(config.get("port", 1)), address=int(config.get("address", 0x3C)))
+        # Only the changed part of the frame is sent over the bus
+        return getattr(luma.oled.device, driver)(serial, width=width, height=height, rotate=rotate,
+                                                framebuffer=diff_to_previous(num_segments=1))
+
+    def compose(self, now):
+        control_unit = self._control_unit
+        mode = control_unit.hvac_mode
+        if control_unit.changeover_state == MODE_DRAINING:
+            mode = f"{MODE_DRAINING} {control_unit.target_mode}"
+        lines = [f"{control_unit.name[:10]} {mode}"]
+
+        per_page = self.rows - 1
+        pages = max(1, math.ceil(len(self._thermostats) / per_page))
+        if now - self.page_started >= self.page_interval:
+            self.page += 1
+            self.page_started = now
+        self.page %= pages
+
+        for thermostat in self._thermostats[self.page * per_page:(self.page + 1) * per_page]:
+            room = control_unit.room_index.get(thermostat.id)
+            valve = "*" if room and room.valve == MODE_OPEN else " "
+            lines.append(f"{valve}{thermostat.room['name'][:9]:<9} {thermostat.current_temp:4.1f}/{thermostat.target_temp:4.1f}")
+        lines += [""] * (self.rows - len(lines))
+        return lines
 
     def update(self):
+        self.changed.set()
+
+    def render(self):
+        dirty = [row for row in range(self.rows) if self.lines[row] != self.drawn[row]]
+        if not dirty:
+            return False
+
+        for row in dirty:
+            top = row * self.row_height
+            self.draw.rectangle((0, top, self.device.width - 1, top + self.row_height - 1), fill=0)
+            self.draw.text((0, top), self.lines[row], font=self.font, fill=255)
+            self.drawn[row] = self.lines[row]
+        # The bus transfer blocks, keep it off the hub
+        gevent.get_hub().threadpool.apply(self.device.display, (self.image,))
+        return True
+
+    def run(self):
+        frame_interval = 1.0 / self.fps
+        while True:
+            self.changed.wait(self.page_interval)
+            self.changed.clear()
+            started = clock()
+            self.lines = self.compose(started)
+            try:
+                self.render()
+            except Exception as e:
+                self.logger.error("Failed to update display: %s", e)
+                # Redraw everything once the panel is back
+                self.drawn = [None] * self.rows
+            # Changes arriving meanwhile are picked up by the next frame
+            gevent.sleep(max(0.0, frame_interval - (clock() - started)))
+
+def mqtt_topic(template, object_id):
+    return template.replace("<component>", "device").replace("<object_id>", object_id)
+
+class PayloadCache:
+    def __init__(self, build):
+        self.build = build
+        self.version = None
+        # The built object as well, shared read-only with the state stream
+        self.value = None
+        self.payload = None
+        self.etag = None
+
+    def get(self, version=0):
+        # Rebuilds and encodes the payload only when the owner's version has moved on
+        if self.version != version:
+            self.value = self.build()
+            self.payload = json.dumps(self.value).encode()
+            self.etag = "%08x" % (zlib.crc32(self.payload))
+            self.version = version
+        return self.payload
+
+def merge_patch(old, new):
+    # RFC 7386 JSON merge patch turning old into new, None when they are equal
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return None if old == new else new
+    patch = {}
+    for k in old:
+        if k not in new:
+            patch[k] = None
+    for k, v in new.items():
+        if k not in old:
+            patch[k] = v
+        elif old[k] != v:
+            if isinstance(old[k], dict) and isinstance(v, dict):
+                patch[k] = merge_patch(old[k], v)
+            else:
+                patch[k] = v
+    return patch if patch else None
 
-        self.lines[0] = ""
-    
-def add_cors(response):
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "*"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    return response
-
-class ThermostatAPI(FlaskView):
-    def __init__(self, args):
-       self._thermostats = args
-
-    def index(self):
-        ret = {}
-        for thermostat in self._thermostats:
-            ret[thermostat.id] = thermostat.to_dict()
-        resp = jsonify(ret)
-        return add_cors(resp)
-    
-    @route('/<id>', methods=['GET', 'OPTIONS'])
-    def thermostat(self, id):
-        ret = {}
-        for thermostat in self._thermostats:
-            if thermostat.id == id:
-                ret = thermostat.to_dict()
-        resp = jsonify(ret)
-        return add_cors(resp)
-
-    @route('/<id>', methods=['POST'])
-    def thermostat_set(self, id):
-        ret = {}
-        if request.method == 'POST':
-            for thermostat in self._thermostats:
-                if thermostat.id == id:
-                    thermostat.set_target_temp(request.json.get('set'))
-                    ret = thermostat.to_dict()
-        resp = jsonify(ret)
-        return add_cors(resp)
-
-class WebAPI(FlaskView):
-    help_message = """
-    <h1>API definition</h1>
-    
-    <pre>
-    GET /thermostats/
-    GET /status/
-    GET /device/
-    
-    POST /thermostats/<id>/
-    {"set":22.5}
-    </pre>
-    """
-    def __init__(self, args):
-        self._control_unit = args
-
-    def index(self):
-        resp = Response(self.help_message)
-        return add_cors(resp)
-
-    def device(self):
-        resp = jsonify(self._control_unit.get_mqtt_discovery_message())
-        return add_cors(resp)
+class StateStream:
+    def __init__(self, logger, control_unit, thermostats, queue_size=16):
+        self.logger = logger
+        self.control_unit = control_unit
+        self.thermostats = thermostats
+        self.queue_size = queue_size
 
-    def status(self):
-        resp = jsonify(self._control_unit.to_dict())
-        return add_cors(resp)
+        self.subscribers = set()
+        # Version each part of the snapshot was taken at, rooms by id
+        self.versions = {}
+        self.room_versions = {}
+        self.snapshot = {"device": None, "status": None, "thermostats": {}}
+        self.update()
 
+    def update(self):
+        # Only the parts whose version moved are diffed, taken from the payload caches
+        patch = {}
+        control_unit = self.control_unit
+        for key, cache, version in (("device", control_unit.discovery_cache, control_unit.discovery_version),
+                                    ("status", control_unit.dict_cache, control_unit.state_version)):
+            if self.versions.get(key) != version:
+                self.versions[key] = version
+                cache.get(version)
+                change = merge_patch(self.snapshot[key], cache.value)
+                self.snapshot[key] = cache.value
+                if change is not None:
+                    patch[key] = change
+
+        rooms = self.snapshot["thermostats"]
+        room_patch = {}
+        for thermostat in self.thermostats:
+            version = thermostat.state_version
+            if self.room_versions.get(thermostat.id) == version:
+                continue
+            self.room_versions[thermostat.id] = version
+            thermostat.dict_cache.get(version)
+            change = merge_patch(rooms.get(thermostat.id), thermostat.dict_cache.value)
+            rooms[thermostat.id] = thermostat.dict_cache.value
+            if change is not None:
+                room_patch[thermostat.id] = change
+        if len(rooms) != len(self.thermostats):
+            # Removed by a config reload
+            room_ids = {thermostat.id for thermostat in self.thermostats}
+            for room_id in [room_id for room_id in rooms if room_id not in room_ids]:
+                del rooms[room_id]
+                del self.room_versions[room_id]
+                room_patch[room_id] = None
+        if room_patch:
+            patch["thermostats"] = room_patch
+        if not patch:
+            return
+
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(patch)
+            except gevent.queue.Full:
+                # Slow client, drop what it has not read yet and resend the whole snapshot
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def subscribe(self):
+        queue = gevent.queue.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+class RoomState:
+    __slots__ = (
+        "id",
+        "gpio",
+        "mode",
+        "valve",
+        "valve_request",
+        "valve_last_changed",
+        "heating_enabled",
+        "cooling_enabled",
+        "switch_times",
+    )
+
+    def __init__(self, room):
+        self.id = room["id"]
+
+        self.mode = MODE_OFF
+        self.valve = MODE_CLOSED
+        self.valve_request = MODE_CLOSED
+        self.valve_last_changed = clock()
+        # When the valve switched within the last hour, for the actuation budget
+        self.switch_times = deque()
+
+        self.configure(room)
+
+    def configure(self, room):
+        self.gpio = room["relay_gpio"]
+
+        self.cooling_enabled = True
+        self.heating_enabled = True
+        if "cooling" in room and not room["cooling"]:
+            self.cooling_enabled = False
+        if "heating" in room and not room["heating"]:
+            self.heating_enabled = False
 
 class ControlUnit:
-    def __init__(self, logger, config):
+    def __init__(self, logger, config, relays):
         self.logger = logger
+        self.relays = relays
         self.config = config["control"]
+        self.deferral_counters = {reason: VALVE_DEFERRALS.labels(reason) for reason in ("min_cycle", "stagger", "budget", "bypass")}
 
         self.id = self.config["id"]
         self.unique_id = self.id
-        self.name = self.config["name"]
         self.state_topic = config["mqtt"]["state_topic"]
         self.discovery_topic = config["mqtt"]["discovery_topic"]
+        self.state_qos = mqtt_qos(config["mqtt"], "state")
+        self.mqtt_state_topic = mqtt_topic(self.state_topic, self.id)
+        self.mqtt_discovery_topic = mqtt_topic(self.discovery_topic, self.id)
 
-        self.hvac_mode = MODE_OFF
-        self.set_mode(MODE_OFF)
-        self.mode_last_changed = time.monotonic()
+        # Bumped whenever anything in the state messages changes
+        self.state_version = 0
+        # Bumped when the discovery document changes (rooms added or removed)
+        self.discovery_version = 0
+        self.mqtt_state_cache = PayloadCache(self.get_mqtt_state_message)
+        self.dict_cache = PayloadCache(self.to_dict)
+        self.discovery_cache = PayloadCache(self.get_mqtt_discovery_message)
 
-        self.min_cycle_duration = self.config["min_cycle_duration"]
-        self.valve_min_cycle_duration = self.config["valve_min_cycle_duration"]
-
-        self.mode_preference = self.config["mode_preference"]
+        self.configure(self.config)
 
         self.heat_gpio = self.config["heat_relay_gpio"]
         self.cool_gpio = self.config["cool_relay_gpio"]
 
-        self.modes = {}
-        self.valves = {}
-        self.valve_requests = {}
-        self.valve_last_changed = {}
-        self.gpios = {}
-        self.cooling_enabled = {}
-        self.heating_enabled = {}
-        for room in config["rooms"]:
-            room_id = room["id"]
-            self.modes[room_id] = MODE_OFF
-            
-            self.valves[room_id] = MODE_CLOSED
-            self.valve_requests[room_id] = MODE_CLOSED
-            self.valve_last_changed[room_id] = time.monotonic()
+        # hvac_mode is the mode currently energized, target_mode the one being changed
+        # into. While changing over the state is MODE_DRAINING with both relays off.
+        self.hvac_mode = MODE_OFF
+        self.target_mode = MODE_OFF
+        self.changeover_state = MODE_OFF
+        self.changeover_until = None
+        self.mode_last_changed = clock()
+        # Earliest time a change blocked by a minimum cycle duration becomes possible
+        self.next_deadline = None
+        # Number of relays switched by the last control pass
+        self.relays_switched = 0
+
+        self.rooms = [RoomState(room) for room in config["rooms"]]
+        self.room_index = {room.id: room for room in self.rooms}
+
+        # Number of rooms requesting each mode, kept up to date by request_mode
+        self.mode_requests = {MODE_HEAT: 0, MODE_COOL: 0, MODE_OFF: len(self.rooms)}
+        # Rooms whose valve needs to be looked at on the next control pass
+        self.valve_dirty = set(self.rooms)
+        self.last_valve_opened = float("-inf")
+        # Closing valve currently held open for the bypass guarantee
+        self.bypass_held = None
+
+    def configure(self, control_config):
+        self.config = control_config
+        self.name = self.config["name"]
+        self.min_cycle_duration = self.config["min_cycle_duration"]
+        self.valve_min_cycle_duration = self.config["valve_min_cycle_duration"]
+        # Both relays are kept off for this many seconds when changing modes
+        self.changeover_dead_time = float(self.config.get("changeover_dead_time", 1))
+        # Valve openings are spread this many seconds apart to limit inrush on the actuator supply
+        self.valve_stagger = float(self.config.get("valve_stagger", 0))
+        # Switches allowed per valve in any hour, 0 for no limit
+        self.valve_max_switches_per_hour = int(self.config.get("valve_max_switches_per_hour", 0))
+        # Kept open while the heat source may run and no other valve is
+        self.bypass_room = self.config.get("bypass_room")
 
-            self.cooling_enabled[room_id] = True
-            self.heating_enabled[room_id] = True
-            if "cooling" in room and not room["cooling"]:
-                self.cooling_enabled[room_id] = False
-            if "heating" in room and not room["heating"]:
-                self.heating_enabled[room_id] = False
+        self.mode_preference = self.config["mode_preference"]
 
-            self.gpios[room_id] = room["relay_gpio"]
+    def apply_config(self, config):
+        discovery = self.discovery_cache.get(self.discovery_version)
+        self.configure(config["control"])
+
+        rooms = []
+        released = []
+        moved = []
+        for room_config in config["rooms"]:
+            room = self.room_index.get(room_config["id"])
+            if room is None:
+                room = RoomState(room_config)
+                self.mode_requests[room.mode] += 1
+            elif room.gpio != room_config["relay_gpio"]:
+                released.append(room.gpio)
+                moved.append(room)
+                room.configure(room_config)
+            else:
+                room.configure(room_config)
+            rooms.append(room)
+
+        room_ids = [room.id for room in rooms]
+        for room in self.rooms:
+            if room.id not in room_ids:
+                released.append(room.gpio)
+                self.mode_requests[room.mode] -= 1
+                self.valve_dirty.discard(room)
+
+        # Every line given up is switched off before the moved rooms carry their valve state
+        # over, a line can pass from one room to another (two rooms swapping relays)
+        for gpio in released:
+            self.relays.set(gpio, False)
+        for room in moved:
+            self.relays.set(room.gpio, room.valve == MODE_OPEN)
+
+        self.rooms = rooms
+        self.room_index = {room.id: room for room in self.rooms}
+        self.valve_dirty.update(self.rooms)
+        self.state_version += 1
+        if json.dumps(self.get_mqtt_discovery_message()).encode() != discovery:
+            self.discovery_version += 1
 
     def mode(self):
         return self.hvac_mode
 
+    def restore(self, snapshot):
+        now = clock()
+        self.hvac_mode = snapshot["hvac_mode"]
+        self.target_mode = snapshot["target_mode"]
+        self.mode_last_changed = now - snapshot["mode_age"]
+        if self.hvac_mode != self.target_mode:
+            # Interrupted in the middle of a changeover, do the dead time again
+            self.changeover_state = MODE_DRAINING
+            self.changeover_until = now + self.changeover_dead_time
+        else:
+            self.changeover_state = self.hvac_mode
+
+        for room_id, saved in snapshot["rooms"].items():
+            room = self.room_index.get(room_id)
+            if room is None:
+                continue
+            self.mode_requests[room.mode] -= 1
+            self.mode_requests[saved["mode"]] += 1
+            room.mode = saved["mode"]
+            room.valve = saved["valve"]
+            room.valve_last_changed = now - saved["valve_age"]
+        self.valve_dirty.update(self.rooms)
+        self.state_version += 1
+
     def set_mode(self, new_mode):
-        if self.hvac_mode != new_mode:
-            self.logger.info(f"Control unit switching to {new_mode}")
+        if self.target_mode != new_mode:
+            self.logger.info("Control unit switching to %s", new_mode)
 
             # Turn off both relays            
-            set_gpio_state(self.heat_gpio, False)
-            set_gpio_state(self.cool_gpio, False)
-
-            gevent.sleep(1)
-
-            self.hvac_mode = new_mode
-            if self.hvac_mode == MODE_HEAT:
-                set_gpio_state(self.heat_gpio, True)
-            if self.hvac_mode == MODE_COOL:
-                set_gpio_state(self.cool_gpio, True)
-
+            self.relays.set(self.heat_gpio, False)
+            self.relays.set(self.cool_gpio, False)
+
+            self.hvac_mode = MODE_OFF
+            self.target_mode = new_mode
+            self.mode_last_changed = clock()
+            self.state_version += 1
+            self.valve_dirty.update(self.rooms)
+            if new_mode == MODE_OFF:
+                self.changeover_state = MODE_OFF
+                self.changeover_until = None
+            else:
+                self.changeover_state = MODE_DRAINING
+                self.changeover_until = self.mode_last_changed + self.changeover_dead_time
+
+    def advance_changeover(self):
+        if self.changeover_state != MODE_DRAINING:
+            return
+
+        if clock() < self.changeover_until:
+            self.defer(self.changeover_until)
+            return
+
+        self.logger.info("Control unit changeover to %s complete", self.target_mode)
+        CHANGEOVER_SECONDS.observe(clock() - self.mode_last_changed)
+        self.hvac_mode = self.target_mode
+        self.changeover_state = self.target_mode
+        self.state_version += 1
+        self.changeover_until = None
+        if self.hvac_mode == MODE_HEAT:
+            self.relays.set(self.heat_gpio, True)
+        if self.hvac_mode == MODE_COOL:
+            self.relays.set(self.cool_gpio, True)
 
     def room_mode(self, room_id):
-        return self.modes[room_id]
+        return self.room_index[room_id].mode
 
     def request_mode(self, room_id, new_mode):
-        if self.modes[room_id] != new_mode:
-            self.logger.info(f"Room {room_id} requests {new_mode}")
-            self.modes[room_id] = new_mode
-
-    def operate_valve(self, room_id, new_state):
-        if self.hvac_mode == MODE_HEAT and not self.heating_enabled[room_id]:
-            new_state = MODE_CLOSED
-        if self.hvac_mode == MODE_COOL and not self.cooling_enabled[room_id]:
-            new_state = MODE_CLOSED
-
-        if self.valves[room_id] != new_state:
-            if (time.monotonic() - self.valve_last_changed[room_id]) >= self.valve_min_cycle_duration:
-                self.logger.info(f"Changing valve {room_id} state from {self.valves[room_id]} to {new_state}")
-            
-                gpio = self.gpios[room_id]
-                set_gpio_state(gpio, True if new_state == MODE_OPEN else False)
-            
-                self.valves[room_id] = new_state
-                self.valve_last_changed[room_id] = time.monotonic()
+        room = self.room_index[room_id]
+        if room.mode != new_mode:
+            self.logger.info("Room %s requests %s", room_id, new_mode)
+            self.mode_requests[room.mode] -= 1
+            self.mode_requests[new_mode] += 1
+            room.mode = new_mode
+            self.valve_dirty.add(room)
+
+    def allowed_state(self, room, new_state):
+        if self.target_mode == MODE_HEAT and not room.heating_enabled:
+            return MODE_CLOSED
+        if self.target_mode == MODE_COOL and not room.cooling_enabled:
+            return MODE_CLOSED
+        return new_state
+
+    def postpone(self, room, deadline, reason):
+        self.defer(deadline)
+        self.valve_dirty.add(room)
+        self.deferral_counters[reason].inc()
+
+    def within_budget(self, room, now):
+        while room.switch_times and now - room.switch_times[0] >= 3600:
+            room.switch_times.popleft()
+        if self.valve_max_switches_per_hour and len(room.switch_times) >= self.valve_max_switches_per_hour:
+            self.postpone(room, room.switch_times[0] + 3600, "budget")
+            return False
+        return True
+
+    def operate_valve(self, room, new_state, now):
+        self.logger.info("Changing valve %s state from %s to %s", room.id, room.valve, new_state)
+        self.relays.set(room.gpio, True if new_state == MODE_OPEN else False)
+
+        room.valve = new_state
+        room.valve_last_changed = now
+        room.switch_times.append(now)
+        self.state_version += 1
+
+    def plan_valves(self, rooms, now):
+        # All valve changes of one tick are planned together
+        openings = []
+        closings = []
+        for room in rooms:
+            new_state = self.allowed_state(room, room.valve_request)
+            if room.valve == new_state:
+                continue
+            if (now - room.valve_last_changed) < self.valve_min_cycle_duration:
+                self.postpone(room, room.valve_last_changed + self.valve_min_cycle_duration, "min_cycle")
+            elif self.within_budget(room, now):
+                (openings if new_state == MODE_OPEN else closings).append(room)
+
+        # One opening at a time, the rooms that have waited longest first
+        openings.sort(key=lambda room: room.valve_last_changed)
+        for room in openings:
+            if self.valve_stagger and now < self.last_valve_opened + self.valve_stagger:
+                self.postpone(room, self.last_valve_opened + self.valve_stagger, "stagger")
+                continue
+            self.operate_valve(room, MODE_OPEN, now)
+            self.last_valve_opened = now
+
+        held = None
+        if self.bypass_room and self.target_mode != MODE_OFF:
+            # The heat source may run, never leave it without an open circuit
+            still_open = sum(1 for room in self.rooms if room.valve == MODE_OPEN) - len(closings)
+            if still_open <= 0:
+                bypass = self.room_index.get(self.bypass_room)
+                can_open = bypass is not None and bypass.valve == MODE_CLOSED and self.allowed_state(bypass, MODE_OPEN) == MODE_OPEN
+                if can_open and (now - bypass.valve_last_changed) >= self.valve_min_cycle_duration:
+                    # Opened regardless of stagger and budget, re-evaluated once another valve is open
+                    self.logger.info("Opening bypass valve %s", bypass.id)
+                    self.operate_valve(bypass, MODE_OPEN, now)
+                    self.last_valve_opened = now
+                    self.valve_dirty.add(bypass)
+                elif closings:
+                    keep = bypass if bypass in closings else closings[-1]
+                    closings.remove(keep)
+                    # Looked at again on the next tick, which any opening brings
+                    self.valve_dirty.add(keep)
+                    held = keep
+                    # Counted once when the hold starts, not for every tick it lasts
+                    if keep is not self.bypass_held:
+                        self.deferral_counters["bypass"].inc()
+                elif can_open:
+                    # Nothing left to hold open, the bypass opens once its own minimum cycle is over
+                    self.defer(bypass.valve_last_changed + self.valve_min_cycle_duration)
+                    self.valve_dirty.add(bypass)
+                    held = bypass
+                    if bypass is not self.bypass_held:
+                        self.deferral_counters["bypass"].inc()
+        self.bypass_held = held
+
+        for room in closings:
+            self.operate_valve(room, MODE_CLOSED, now)
+
+    def defer(self, deadline):
+        if self.next_deadline is None or deadline < self.next_deadline:
+            self.next_deadline = deadline
 
     def to_dict(self):
         msg = {
@@ -217,15 +868,14 @@ class ControlUnit:
             "cold": (self.hvac_mode == MODE_COOL),
             "valves": {},
         }
-        for room_id, valve in self.valves.items():
-            msg["valves"][room_id] = (valve == MODE_OPEN)
+        for room in self.rooms:
+            msg["valves"][room.id] = (room.valve == MODE_OPEN)
         return msg
 
-    def publish_mqtt_state_message(self, client):
-        msg = self.get_mqtt_state_message()
-        state_topic = self.state_topic.replace("<component>", "device").replace("<object_id>", self.id)
-        logger.info(f"Publishing control unit state message for {self.id} to {state_topic}")
-        client.publish(state_topic, json.dumps(msg), qos=2)
+    def publish_mqtt_state_message(self, publisher, force=False):
+        payload = self.mqtt_state_cache.get(self.state_version)
+        if publisher.publish_state(self.mqtt_state_topic, payload, force):
+            self.logger.debug("Published control unit state message for %s to %s", self.id, self.mqtt_state_topic)
 
     def get_mqtt_state_message(self):
         msg = {
@@ -233,19 +883,17 @@ class ControlUnit:
             "cold": "ON" if self.hvac_mode == MODE_COOL else "OFF",
             "valves": {},
         }
-        for room_id, valve in self.valves.items():
-            msg["valves"][room_id] = "ON" if valve == MODE_OPEN else "OFF"
+        for room in self.rooms:
+            msg["valves"][room.id] = "ON" if room.valve == MODE_OPEN else "OFF"
         return msg
 
-    def publish_mqtt_discovery_message(self, client):
-        msg = self.get_mqtt_discovery_message()
-        discovery_topic = self.discovery_topic.replace("<component>", "device").replace("<object_id>", self.id)
-        logger.info(f"Publishing control unit discovery message for {self.id} to {discovery_topic}")
-        client.publish(discovery_topic, json.dumps(msg), qos=2)
+    def publish_mqtt_discovery_message(self, publisher):
+        self.logger.info("Publishing control unit discovery message for %s to %s", self.id, self.mqtt_discovery_topic)
+        publisher.publish_discovery(self.mqtt_discovery_topic, self.discovery_cache.get(self.discovery_version))
 
     def get_mqtt_discovery_message(self):
         mqtt_id = self.id
-        state_topic = self.state_topic.replace("<component>", "device").replace("<object_id>", mqtt_id)
+        state_topic = mqtt_topic(self.state_topic, mqtt_id)
         msg = { 
             "dev": {
                 "ids": mqtt_id,
@@ -276,23 +924,25 @@ class ControlUnit:
                 }
             },
             "state_topic": state_topic,
-            "qos": 2
+            "qos": self.state_qos
         }
-        for room_id, valve in self.valves.items():
-            msg["cmps"][f"valve_{room_id}"] = {
+        for room in self.rooms:
+            msg["cmps"][f"valve_{room.id}"] = {
                 "p": "binary_sensor",
                 "device_class": "opening",
-                "value_template": ("{{ value_json.valves.%s }}" % (room_id)),
-                "unique_id": f"{self.unique_id}v{room_id}",
+                "value_template": ("{{ value_json.valves.%s }}" % (room.id)),
+                "unique_id": f"{self.unique_id}v{room.id}",
             }
         return msg
 
 
     def control(self):
-        heating_requested = any(map(lambda x: x == MODE_HEAT, self.modes.values()))
-        cooling_requested = any(map(lambda x: x == MODE_COOL, self.modes.values()))
+        self.next_deadline = None
+
+        heating_requested = self.mode_requests[MODE_HEAT] > 0
+        cooling_requested = self.mode_requests[MODE_COOL] > 0
 
-        self.logger.info(f"Heating requested: {heating_requested}, cooling requested: {cooling_requested}")
+        self.logger.debug("Heating requested: %s, cooling requested: %s", heating_requested, cooling_requested)
         new_mode = MODE_OFF
         if heating_requested and cooling_requested:
             if self.mode_preference == MODE_HEAT:
@@ -306,37 +956,50 @@ class ControlUnit:
         else:
             # Could be heat, cool or off
             new_mode = self.mode_preference
-        if (time.monotonic() - self.mode_last_changed) >= self.min_cycle_duration:
-            self.set_mode(new_mode)
-
-        for room_id, room_request in self.modes.items():
-            if self.hvac_mode == MODE_COOL:
-                if room_request == MODE_COOL:
-                    self.valve_requests[room_id] = MODE_OPEN
-                else:
-                    self.valve_requests[room_id] = MODE_CLOSED
-            if self.hvac_mode == MODE_HEAT:
-                if room_request == MODE_HEAT:
-                    self.valve_requests[room_id] = MODE_OPEN
-                else:
-                    self.valve_requests[room_id] = MODE_CLOSED
-            if self.hvac_mode == MODE_OFF:
-                self.valve_requests[room_id] = MODE_CLOSED
+        if new_mode != self.target_mode:
+            if (clock() - self.mode_last_changed) >= self.min_cycle_duration:
+                self.set_mode(new_mode)
+            else:
+                self.defer(self.mode_last_changed + self.min_cycle_duration)
+        self.advance_changeover()
+
+        # Valves are positioned for the target mode while the changeover is in progress.
+        # Only rooms whose request or the target mode changed, or which are still waiting
+        # for valve_min_cycle_duration, are looked at.
+        now = clock()
+        pending = self.valve_dirty
+        self.valve_dirty = set()
+        for room in pending:
+            if self.target_mode != MODE_OFF and room.mode == self.target_mode:
+                room.valve_request = MODE_OPEN
+            else:
+                room.valve_request = MODE_CLOSED
+        self.plan_valves(pending, now)
 
-        for room_id, desired_state in self.valve_requests.items():
-            self.operate_valve(room_id, desired_state)
+        # Apply all relay changes of this tick in one write
+        self.relays_switched = self.relays.commit()
+        return self.next_deadline
             
+class ThermostatRegistry(list):
+    # The shared list of thermostats, with an index for lookups by room id
+    def __init__(self, thermostats=()):
+        super().__init__(thermostats)
+        self.index = {thermostat.id: thermostat for thermostat in self}
+
+    def get(self, room_id):
+        return self.index.get(room_id)
+
+    def replace(self, thermostats):
+        # Updated in place, the same object is shared with the web API and publishers
+        self[:] = thermostats
+        self.index = {thermostat.id: thermostat for thermostat in self}
+
 class Thermostat:
     def __init__(self, logger, control_unit, config, room):
         self.logger = logger
-        self.config = config
         self.control_unit = control_unit
 
         self.id = room["id"] 
-        self.room = room
-        self.zigbee2mqtt = {}
-        if "zigbee2mqtt" in room:
-            self.zigbee2mqtt = room["zigbee2mqtt"]
 
         self.max_temp = float(config["control"]["max_temperature"])
         self.min_temp = float(config["control"]["min_temperature"])
@@ -345,52 +1008,188 @@ class Thermostat:
         self.current_temp = float(config["control"]["initial_temperature"])
 
         self.current_mode = MODE_OFF
+
+        # Field -> clock() of the last received value, repeated values included
+        self.updated = {}
+        # Readings are expected from the time the room is set up
+        self.watched_since = clock()
+        self.stale = False
+        # clock() when the room last turned stale
+        self.stale_since = None
+
+        self.configure(config, room)
+
+        self.state_topic = config["mqtt"]["state_topic"]
+        self.discovery_topic = config["mqtt"]["discovery_topic"]
+        self.state_qos = mqtt_qos(config["mqtt"], "state")
+        # Room ids only need to be unique within a control unit, MQTT ids across all of them
+        self.object_id = f"{config['namespace']}_{self.id}" if config.get("namespace") else self.id
+        self.mqtt_state_topic = mqtt_topic(self.state_topic, self.object_id)
+        self.mqtt_discovery_topic = mqtt_topic(self.discovery_topic, self.object_id)
+        self.component_type = "sensor"
+        self.unique_id = f"sensor{self.object_id}"
+        self.stale_counter = SENSOR_STALE.labels(self.object_id)
+
+        # Bumped whenever anything in the state messages changes
+        self.state_version = 0
+        self.discovery_version = 0
+        # Bumped whenever a temperature field is set, whatever set it
+        self.input_version = 0
+        self.mqtt_state_cache = PayloadCache(self.get_mqtt_state_message)
+        self.dict_cache = PayloadCache(self.to_dict)
+        self.discovery_cache = PayloadCache(self.get_mqtt_discovery_message)
+
+        # Called with the thermostat whenever a control input changes
+        self.on_change = None
+        # Set up by HistoryRecorder
+        self.history = None
+        # Set up by StaleSensorMonitor, with the deadline of the room's current entry there
+        self.stale_monitor = None
+        self.stale_check = None
+
+        self.schedule = SetpointSchedule(room["schedule"]) if "schedule" in room else None
+        # Day and index of the last schedule transition applied
+        self.schedule_applied = None
+
+    def configure(self, config, room):
+        self.config = config
+        self.room = room
+        self.zigbee2mqtt = {}
+        if "zigbee2mqtt" in room:
+            self.zigbee2mqtt = room["zigbee2mqtt"]
+
         self.cooling_supported = self.room["cooling"] if "cooling" in self.room else True
         self.heating_supported = self.room["heating"] if "heating" in self.room else True
 
         self.cold_tolerance = float(config["control"]["cold_tolerance"])
         self.heat_tolerance = float(config["control"]["heat_tolerance"])
 
-        self.state_topic = config["mqtt"]["state_topic"]
-        self.discovery_topic = config["mqtt"]["discovery_topic"]
-        self.component_type = "sensor"
-        self.unique_id = f"sensor{self.id}"
+        # Seconds without a temperature reading before the room falls back to stale_action, 0 = never
+        self.stale_after = float(self.room.get("stale_after", config["control"].get("stale_after", 0)))
+        self.stale_action = config["control"].get("stale_action", STALE_CLOSE)
+        self.off_temperature = float(config["control"].get("off_temperature", 0))
+        # The frozen reading never rises, so off_temperature heats at most this long
+        self.stale_max_heat = float(config["control"].get("stale_max_heat", 1800))
+
+    def apply_config(self, config, room):
+        # Returns whether anything published about this thermostat changed
+        old_room = self.room
+        old_control = self.config["control"]
+        tolerances = (self.cold_tolerance, self.heat_tolerance)
+        self.configure(config, room)
+        if (old_control["min_temperature"], old_control["max_temperature"]) != (config["control"]["min_temperature"], config["control"]["max_temperature"]):
+            # The new limits hold until the device reports its own again
+            self.update("min_temp", float(config["control"]["min_temperature"]))
+            self.update("max_temp", float(config["control"]["max_temperature"]))
+            self.set_target_temperature(self.target_temp)
+        if old_room.get("name") != room.get("name"):
+            self.discovery_version += 1
+            self.state_version += 1
+        if tolerances != (self.cold_tolerance, self.heat_tolerance) and self.on_change:
+            self.on_change(self)
+        if old_room.get("schedule") != room.get("schedule"):
+            # Only a changed schedule in the file replaces one set through the API
+            self.set_schedule(SetpointSchedule(room["schedule"]) if "schedule" in room else None)
+        return old_room != room or tolerances != (self.cold_tolerance, self.heat_tolerance)
+
+    def update(self, field, value):
+        # Returns whether the value actually changed
+        if getattr(self, field) == value:
+            return False
+        setattr(self, field, value)
+        self.state_version += 1
+        self.input_version += 1
+        if self.on_change:
+            self.on_change(self)
+        return True
 
     def set_target_temp(self, v):
-        if v:
-            self.target_temp = float(v)
+        return bool(v) and self.update("target_temp", float(v))
 
     def set_current_temp(self, v):
-        if v:
-            self.current_temp = float(v)
+        return bool(v) and self.update("current_temp", float(v))
 
     def set_max_temp(self, v):
-        if v:
-            self.max_temp = float(v)
+        return bool(v) and self.update("max_temp", float(v))
     
     def set_min_temp(self, v):
-        if v:
-            self.min_temp = float(v)
+        return bool(v) and self.update("min_temp", float(v))
+
+    def touch(self, field, now):
+        # Called for every received sensor field, also when the value did not change
+        self.updated[field] = now
+        if field == "current_temp" and self.stale:
+            self.set_stale(False)
+            if self.stale_monitor:
+                self.stale_monitor.watch(self)
+
+    def stale_expiry(self):
+        # When the room turns stale unless a reading comes in, None if it is not watched
+        if not self.stale_after or "current_temp" not in self.zigbee2mqtt:
+            return None
+        return self.updated.get("current_temp", self.watched_since) + self.stale_after
+
+    def stale_heat_expiry(self):
+        # When a stale room stops heating for frost protection, None if it never heats
+        if not self.stale or self.stale_action != STALE_OFF_TEMPERATURE or not self.stale_max_heat:
+            return None
+        return self.stale_since + self.stale_max_heat
+
+    def set_stale(self, stale):
+        if stale == self.stale:
+            return
+        self.stale = stale
+        if stale:
+            self.stale_since = clock()
+            self.logger.warning("No temperature from %s for %.0f s, falling back to %s", self.id, self.stale_after, self.stale_action)
+            self.stale_counter.inc()
+        else:
+            self.logger.info("Temperature readings from %s resumed", self.id)
+        self.state_version += 1
+        if self.on_change:
+            self.on_change(self)
+
+    def freshness(self):
+        now = clock()
+        return {
+            "stale": self.stale,
+            "stale_after": self.stale_after or None,
+            "stale_action": self.stale_action,
+            # Seconds since each field was last received
+            "age": {field: round(now - updated, 1) for field, updated in self.updated.items()},
+        }
+
+    def set_schedule(self, schedule):
+        self.schedule = schedule
+        self.schedule_applied = None
 
     def get_zigbee2mqtt(self):
         return self.zigbee2mqtt
 
+    def restore(self, saved, fresh=True):
+        # Within the configured limits, they may have changed while we were down
+        self.target_temp = min(max(saved["target_temp"], self.min_temp), self.max_temp)
+        if fresh:
+            self.current_temp = saved["current_temp"]
+            self.current_mode = saved["mode"]
+        self.state_version += 1
+
     def set_target_temperature(self, temperature):
-        self.target_temp = float(temperature)
-        if self.target_temp > self.max_temp:
-            self.target_temp = self.max_temp
-        elif self.target_temp < self.min_temp:
-            self.target_temp = self.min_temp
+        target_temp = float(temperature)
+        if target_temp > self.max_temp:
+            target_temp = self.max_temp
+        elif target_temp < self.min_temp:
+            target_temp = self.min_temp
+        return self.update("target_temp", target_temp)
 
     def set_current_temperature(self, temperature):
-        self.current_temp = float(temperature)
+        return self.update("current_temp", float(temperature))
 
 
-    def publish_mqtt_state_message(self, client):
-        msg = self.get_mqtt_state_message()
-        state_topic = self.state_topic.replace("<component>", "device").replace("<object_id>", self.id)
-        logger.info(f"Publishing thermostat unit state message for {self.id} to {state_topic}")
-        client.publish(state_topic, json.dumps(msg), qos=2)
+    def publish_mqtt_state_message(self, publisher, force=False):
+        payload = self.mqtt_state_cache.get(self.state_version)
+        if publisher.publish_state(self.mqtt_state_topic, payload, force):
+            self.logger.debug("Published thermostat unit state message for %s to %s", self.id, self.mqtt_state_topic)
 
     def get_mqtt_state_message(self):
         return {
@@ -398,6 +1197,7 @@ class Thermostat:
             "setpoint_temperature": self.target_temp,
             "heat": "ON" if self.current_mode == MODE_HEAT else "OFF",
             "cool": "ON" if self.current_mode == MODE_COOL else "OFF",
+            "stale": "ON" if self.stale else "OFF",
         }
 
     def to_dict(self):
@@ -406,19 +1206,18 @@ class Thermostat:
             "setpoint_temperature": self.target_temp,
             "heat": (self.current_mode == MODE_HEAT),
             "cool": (self.current_mode == MODE_COOL),
+            "stale": self.stale,
             "name": self.room["name"],
         }
         return ret
 
-    def publish_mqtt_discovery_message(self, client):
-        msg = self.get_mqtt_discovery_message()
-        discovery_topic = self.discovery_topic.replace("<component>", "device").replace("<object_id>", self.id)
-        logger.info(f"Publishing thermostat discovery message for {self.id} to {discovery_topic}")
-        client.publish(discovery_topic, json.dumps(msg), qos=2)
+    def publish_mqtt_discovery_message(self, publisher):
+        self.logger.info("Publishing thermostat discovery message for %s to %s", self.id, self.mqtt_discovery_topic)
+        publisher.publish_discovery(self.mqtt_discovery_topic, self.discovery_cache.get(self.discovery_version))
 
     def get_mqtt_discovery_message(self):
-        mqtt_id = "%s_thermostat" % (self.id)
-        state_topic = self.state_topic.replace("<component>", "device").replace("<object_id>", mqtt_id)
+        mqtt_id = "%s_thermostat" % (self.object_id)
+        state_topic = mqtt_topic(self.state_topic, mqtt_id)
         msg = { 
             "dev": {
                 "ids": mqtt_id,
@@ -461,9 +1260,15 @@ class Thermostat:
                     "value_template": "{{ value_json.cold }}",
                     "unique_id": f"{self.unique_id}stc",
                 },
+                "stale": {
+                    "p": "binary_sensor",
+                    "device_class": "problem",
+                    "value_template": "{{ value_json.stale }}",
+                    "unique_id": f"{self.unique_id}sts",
+                },
             },
             "state_topic": state_topic,
-            "qos": 2
+            "qos": self.state_qos
         }
         return msg
 
@@ -472,117 +1277,1297 @@ class Thermostat:
         min_temp = self.target_temp - self.cold_tolerance
         max_temp = self.target_temp + self.heat_tolerance
 
-        if self.current_temp < min_temp or self.current_temp > max_temp:
+        if self.stale and self.stale_action == STALE_CLOSE:
+            # The last reading can not be trusted, the room asks for nothing and its valve closes
+            new_mode = MODE_OFF
+        elif self.stale:
+            # Only frost protection against the last reading, never cooling, and only for
+            # stale_max_heat after the readings stopped since the reading never catches up
+            heating = clock() - self.stale_since < self.stale_max_heat
+            new_mode = MODE_HEAT if heating and self.current_temp < self.off_temperature - self.cold_tolerance else MODE_OFF
+        elif self.current_temp < min_temp or self.current_temp > max_temp:
             if self.current_temp > self.target_temp:
-                self.control_unit.request_mode(self.id, MODE_COOL)
-                self.current_mode = MODE_COOL
+                new_mode = MODE_COOL
             else:
-                self.control_unit.request_mode(self.id, MODE_HEAT)
-                self.current_mode = MODE_HEAT
+                new_mode = MODE_HEAT
         else:
-            self.control_unit.request_mode(self.id, MODE_OFF)
-            self.current_mode = MODE_OFF
+            new_mode = MODE_OFF
+
+        self.control_unit.request_mode(self.id, new_mode)
+        if self.current_mode != new_mode:
+            self.current_mode = new_mode
+            self.state_version += 1
 
-def control_loop(control_unit, thermostats):
-    while True:
+class ScheduleRunner:
+    # Waits are worked out on the wall clock but slept on the monotonic one, so a DST change
+    # or an NTP step (no RTC on the board) delays a transition by at most this many seconds
+    max_wait = 60
+
+    def __init__(self, logger, thermostats):
+        self.logger = logger
+        self.thermostats = thermostats
+        self.wakeup = gevent.event.Event()
+
+    def apply(self, now):
+        # Applies every transition that is due and returns the seconds until the next one
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        # Ordinal dates, so the day before 1 January is 31 December and not day 0
+        today = date(local.tm_year, local.tm_mon, local.tm_mday).toordinal()
+        timeout = None
+        for thermostat in self.thermostats:
+            schedule = thermostat.schedule
+            if schedule is None:
+                continue
+            index = schedule.active(minute)
+            day = today if minute >= schedule.minutes[0] else today - 1
+            if thermostat.schedule_applied != (day, index):
+                thermostat.schedule_applied = (day, index)
+                self.logger.info("Schedule sets %s to %.1f", thermostat.id, schedule.setpoint(index))
+                thermostat.set_target_temperature(schedule.setpoint(index))
+            wait = schedule.minutes_until_next(minute) * 60 - local.tm_sec - (now % 1)
+            timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+    def run(self):
+        while True:
+            # All rooms due at the same time are changed together and evaluated once
+            timeout = self.apply(time.time())
+            # Waking early costs nothing, transitions already applied are not applied again
+            self.wakeup.wait(min(timeout, self.max_wait) if timeout is not None else None)
+            self.wakeup.clear()
+
+class StaleSensorMonitor:
+    def __init__(self, logger, thermostats):
+        self.logger = logger
+        self.wakeup = gevent.event.Event()
+        # Breaks ties between equal expiry times, thermostats do not compare
+        self.sequence = itertools.count()
+        self.set_thermostats(thermostats)
+
+    def set_thermostats(self, thermostats):
+        # Heap of (deadline, sequence, thermostat), entries whose deadline is no longer the
+        # thermostat's stale_check were superseded and are skipped
+        self.heap = []
         for thermostat in thermostats:
-            thermostat.control()
-        
-        control_unit.control()
+            thermostat.stale_monitor = self
+            if thermostat.stale_expiry() is None:
+                # No longer watched, nothing would ever make it fresh again
+                thermostat.set_stale(False)
+            thermostat.stale_check = self.next_check(thermostat)
+            if thermostat.stale_check is not None:
+                self.heap.append((thermostat.stale_check, next(self.sequence), thermostat))
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    @staticmethod
+    def next_check(thermostat):
+        # A fresh room is checked for its readings running out, a stale one for its heating
+        return thermostat.stale_heat_expiry() if thermostat.stale else thermostat.stale_expiry()
+
+    def watch(self, thermostat):
+        thermostat.stale_check = self.next_check(thermostat)
+        if thermostat.stale_check is None:
+            return
+        heapq.heappush(self.heap, (thermostat.stale_check, next(self.sequence), thermostat))
+        if self.heap[0][2] is thermostat:
+            self.wakeup.set()
+
+    def expire(self, now):
+        # Marks the rooms that are due as stale and returns the seconds until the next expiry.
+        # Readings only update a timestamp, a room that reported in the meantime is pushed back
+        # to its new expiry here, so the cost is per expiry window rather than per message.
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, thermostat = heapq.heappop(self.heap)
+            if deadline != thermostat.stale_check:
+                continue
+            thermostat.stale_check = None
+            if thermostat.stale:
+                # Its frost protection heating ran out, control closes the valve
+                if thermostat.on_change:
+                    thermostat.on_change(thermostat)
+                continue
+            expiry = thermostat.stale_expiry()
+            if expiry is None:
+                continue
+            if expiry <= now:
+                thermostat.set_stale(True)
+            self.watch(thermostat)
+        return self.heap[0][0] - now if self.heap else None
+
+    def run(self):
+        while True:
+            timeout = self.expire(clock())
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+class HistoryTier:
+    def __init__(self, step, duration):
+        self.step = step
+        self.capacity = max(1, int(duration // step))
+
+        # Fixed size ring buffers, allocated once
+        self.times = array("d", bytes(8 * self.capacity))
+        self.temperature = array("f", bytes(4 * self.capacity))
+        self.setpoint = array("f", bytes(4 * self.capacity))
+        self.mode = array("b", bytes(self.capacity))
+        self.valve = array("f", bytes(4 * self.capacity))
+        self.head = 0
+        self.count = 0
+
+        # Running sums for the bucket currently being downsampled into this tier
+        self.bucket = None
+        self.samples = 0
+        self.sum_temperature = 0.0
+        self.sum_setpoint = 0.0
+        self.sum_valve = 0.0
+        self.last_mode = 0
+
+    def append(self, t, temperature, setpoint, mode, valve):
+        i = self.head
+        self.times[i] = t
+        self.temperature[i] = temperature
+        self.setpoint[i] = setpoint
+        self.mode[i] = mode
+        self.valve[i] = valve
+        self.head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def add_sample(self, t, temperature, setpoint, mode, valve):
+        bucket = math.floor(t / self.step)
+        if self.bucket is not None and bucket != self.bucket:
+            self.flush()
+        self.bucket = bucket
+        self.samples += 1
+        self.sum_temperature += temperature
+        self.sum_setpoint += setpoint
+        self.sum_valve += valve
+        self.last_mode = mode
+
+    def flush(self):
+        if self.samples:
+            n = self.samples
+            self.append(self.bucket * self.step, self.sum_temperature / n, self.sum_setpoint / n, self.last_mode, self.sum_valve / n)
+        self.samples = 0
+        self.sum_temperature = 0.0
+        self.sum_setpoint = 0.0
+        self.sum_valve = 0.0
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.times[(self.head - self.count) % self.capacity]
+
+    def indices(self, start, end):
+        first = self.head - self.count
+        for k in range(self.count):
+            i = (first + k) % self.capacity
+            if start <= self.times[i] <= end:
+                yield i
+
+class RoomHistory:
+    def __init__(self, tiers):
+        # The first tier stores raw samples, the rest are means over their step
+        self.tiers = [HistoryTier(tier["step"], tier["duration"]) for tier in tiers]
+
+    def record(self, t, temperature, setpoint, mode, valve):
+        mode = MODE_CODES.index(mode)
+        self.tiers[0].append(t, temperature, setpoint, mode, valve)
+        for tier in self.tiers[1:]:
+            tier.add_sample(t, temperature, setpoint, mode, valve)
+
+    def select_tier(self, start, end):
+        # Finest tier covering the most of [start, end]. A coarser tier only wins when it
+        # reaches back further by more than its own step, so a tier that has barely started
+        # (or is still empty) never hides raw samples early after startup.
+        best = None
+        best_coverage = None
+        for tier in self.tiers:
+            oldest = tier.oldest()
+            if oldest is None:
+                continue
+            coverage = max(0.0, end - max(start, oldest))
+            if best is None or coverage > best_coverage + tier.step:
+                best = tier
+                best_coverage = coverage
+            if best_coverage >= end - start:
+                break
+        return best or self.tiers[0]
+
+    def query(self, start, end, step=0):
+        tier = self.select_tier(start, end)
+        step = max(step, tier.step)
+
+        ret = {"step": step, "modes": MODE_CODES, "t": [], "temperature": [], "setpoint": [], "mode": [], "valve": []}
+        bucket = None
+        n = 0
+        sums = [0.0, 0.0, 0.0]
+        mode = 0
+        for i in tier.indices(start, end):
+            b = math.floor(tier.times[i] / step)
+            if bucket is not None and b != bucket:
+                self.emit(ret, bucket * step, n, sums, mode)
+                n = 0
+                sums = [0.0, 0.0, 0.0]
+            bucket = b
+            n += 1
+            sums[0] += tier.temperature[i]
+            sums[1] += tier.setpoint[i]
+            sums[2] += tier.valve[i]
+            mode = tier.mode[i]
+        if n:
+            self.emit(ret, bucket * step, n, sums, mode)
+        return ret
 
-        gevent.sleep(1)
+    def emit(self, ret, t, n, sums, mode):
+        ret["t"].append(t)
+        ret["temperature"].append(round(sums[0] / n, 2))
+        ret["setpoint"].append(round(sums[1] / n, 2))
+        ret["valve"].append(round(sums[2] / n, 2))
+        ret["mode"].append(mode)
+
+class HistoryRecorder:
+    default_tiers = [
+        {"step": 10, "duration": 3600},
+        {"step": 60, "duration": 86400},
+        {"step": 900, "duration": 2592000},
+    ]
+
+    def __init__(self, logger, control_unit, thermostats, config):
+        self.logger = logger
+        self.control_unit = control_unit
+        self.thermostats = thermostats
+
+        self.tiers = config.get("tiers", self.default_tiers)
+        self.sample_interval = float(config.get("sample_interval", self.tiers[0]["step"]))
+        for thermostat in thermostats:
+            self.attach(thermostat)
+
+    def attach(self, thermostat):
+        thermostat.history = RoomHistory(self.tiers)
+
+    def sample(self):
+        now = time.time()
+        for thermostat in self.thermostats:
+            room = self.control_unit.room_index[thermostat.id]
+            thermostat.history.record(now, thermostat.current_temp, thermostat.target_temp, thermostat.current_mode, room.valve)
+
+    def run(self):
+        while True:
+            self.sample()
+            gevent.sleep(self.sample_interval)
+
+class StateSnapshot:
+    magic = b"ZTS1"
+    # magic, energized mode, target mode, saved at (wall clock), mode last changed (wall clock), rooms
+    header = struct.Struct("<4sBBddI")
+    # room id, requested mode, valve, valve last changed (wall clock), target, current temperature.
+    # The limits are not kept, they come from the config (or the device once it reports them)
+    room = struct.Struct("<32sBBddd")
+    # Longer room ids are rejected by validate_config
+    max_id_bytes = 32
+
+    def __init__(self, logger, control_unit, thermostats, config):
+        self.logger = logger
+        self.control_unit = control_unit
+        self.thermostats = thermostats
+
+        self.path = config.get("path")
+        # Sensor-only changes are written at most this often, mode and valve changes right away
+        self.min_interval = float(config.get("min_interval", 60))
+        self.last_written = None
+        self.last_saved = 0.0
+        self.versions = None
+        self.pending = None
+        # Greenlet writing in the threadpool, and the newest data waiting for it
+        self.writer = None
+        self.queued = None
+
+    @classmethod
+    def load(cls, logger, config):
+        path = config.get("path")
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            return cls.unpack(data, config)
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            logger.warning("Ignoring state snapshot %s: %s", path, e)
+            return None
+
+    @classmethod
+    def unpack(cls, data, config):
+        magic, hvac_mode, target_mode, saved_at, mode_changed, count = cls.header.unpack_from(data, 0)
+        if magic != cls.magic or len(data) != cls.header.size + count * cls.room.size:
+            raise ValueError("unknown format")
+
+        now = time.time()
+        snapshot = {
+            "saved_at": saved_at,
+            # Relays and valves are only trusted if we went down recently
+            "fresh": (now - saved_at) <= float(config.get("max_age", 3600)),
+            "hvac_mode": MODE_CODES[hvac_mode],
+            "target_mode": MODE_CODES[target_mode],
+            "mode_age": max(0.0, now - mode_changed),
+            "rooms": {},
+        }
+        for i in range(count):
+            room_id, mode, valve, valve_changed, target, current = cls.room.unpack_from(data, cls.header.size + i * cls.room.size)
+            snapshot["rooms"][room_id.rstrip(b"\0").decode()] = {
+                "mode": MODE_CODES[mode],
+                "valve": valve,
+                "valve_age": max(0.0, now - valve_changed),
+                "target_temp": target,
+                "current_temp": current,
+            }
+        return snapshot
+
+    @staticmethod
+    def relay_states(snapshot, config):
+        states = {}
+        if snapshot and snapshot["fresh"]:
+            states[config["control"]["heat_relay_gpio"]] = snapshot["hvac_mode"] == MODE_HEAT
+            states[config["control"]["cool_relay_gpio"]] = snapshot["hvac_mode"] == MODE_COOL
+            for room in config["rooms"]:
+                if room["id"] in snapshot["rooms"]:
+                    states[room["relay_gpio"]] = snapshot["rooms"][room["id"]]["valve"] == MODE_OPEN
+        return states
+
+    def restore(self, snapshot):
+        if snapshot["fresh"]:
+            self.control_unit.restore(snapshot)
+        for thermostat in self.thermostats:
+            if thermostat.id in snapshot["rooms"]:
+                thermostat.restore(snapshot["rooms"][thermostat.id], snapshot["fresh"])
+        self.logger.info("Restored state snapshot from %s", time.ctime(snapshot["saved_at"]))
+
+    def pack(self):
+        now = time.time()
+        offset = now - clock()
+        control_unit = self.control_unit
+        parts = [self.header.pack(
+            self.magic,
+            MODE_CODES.index(control_unit.hvac_mode),
+            MODE_CODES.index(control_unit.target_mode),
+            now,
+            control_unit.mode_last_changed + offset,
+            len(self.thermostats),
+        )]
+        for thermostat in self.thermostats:
+            room = control_unit.room_index[thermostat.id]
+            parts.append(self.room.pack(
+                thermostat.id.encode(),
+                MODE_CODES.index(room.mode),
+                room.valve,
+                room.valve_last_changed + offset,
+                thermostat.target_temp,
+                thermostat.current_temp,
+            ))
+        return b"".join(parts)
+
+    def save(self):
+        if self.pending:
+            self.pending.kill(block=False)
+            self.pending = None
+        # Packed here so it is consistent, the file I/O waits on the SD card in the threadpool
+        data = self.pack()
+        self.last_saved = time.monotonic()
+        if self.writer is not None and not self.writer.dead:
+            # Only the newest state matters, it is written once the running write is done
+            self.queued = data
+            return
+        self.writer = gevent.spawn(self.write, data)
+
+    def write(self, data):
+        while data is not None:
+            try:
+                gevent.get_hub().threadpool.apply(self.write_file, (data,))
+            except OSError as e:
+                self.logger.warning("Failed to write state snapshot %s: %s", self.path, e)
+            data, self.queued = self.queued, None
+
+    def write_file(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
 
+    def update(self):
+        if not self.path:
+            return
+        versions = (self.control_unit.state_version,) + tuple(thermostat.state_version for thermostat in self.thermostats)
+        if versions == self.versions:
+            return
+        control_changed = self.versions is None or versions[0] != self.versions[0]
+        self.versions = versions
+
+        wait = self.last_saved + self.min_interval - time.monotonic()
+        if control_changed or wait <= 0:
+            self.save()
+        elif self.pending is None:
+            self.pending = gevent.spawn_later(wait, self.save)
+
+class ControlScheduler:
+    def __init__(self, logger, control_units, thermostats, debounce=0.05):
+        self.logger = logger
+        self.control_units = control_units
+        self.set_thermostats(thermostats)
+
+        self.debounce = debounce
+        self.next_deadline = None
+        self.listeners = []
+        # When the oldest not yet evaluated input change came in
+        self.dirty_since = clock()
+
+        # Everything is evaluated once on startup
+        self.dirty = set(self.thermostats)
+        self.wakeup = gevent.event.Event()
+
+    def set_thermostats(self, thermostats):
+        # Thermostats of every control unit, room ids can repeat between units
+        self.thermostats = set(thermostats)
+        for thermostat in self.thermostats:
+            thermostat.on_change = self.mark_dirty
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def mark_dirty(self, thermostat):
+        if self.dirty_since is None:
+            self.dirty_since = clock()
+        self.dirty.add(thermostat)
+        self.wakeup.set()
+
+    def evaluate(self):
+        started = time.perf_counter()
+        dirty_since = self.dirty_since
+        self.dirty_since = None
+        while self.dirty:
+            thermostat = self.dirty.pop()
+            if thermostat in self.thermostats:
+                thermostat.control()
+
+        self.next_deadline = None
+        relays_switched = False
+        for control_unit in self.control_units:
+            deadline = control_unit.control()
+            if deadline is not None and (self.next_deadline is None or deadline < self.next_deadline):
+                self.next_deadline = deadline
+            if control_unit.relays_switched:
+                relays_switched = True
+        CONTROL_TICK_SECONDS.observe(time.perf_counter() - started)
+        if relays_switched and dirty_since is not None:
+            INPUT_TO_RELAY_SECONDS.observe(clock() - dirty_since)
+
+        for listener in self.listeners:
+            listener()
+
+    def run(self):
+        # Startup normally runs the first pass itself, before anything else is started
+        if self.dirty:
+            self.evaluate()
+        while True:
+            timeout = None
+            if self.next_deadline is not None:
+                timeout = max(0.0, self.next_deadline - clock())
+            if self.wakeup.wait(timeout):
+                # Let a burst of changes settle before acting on them
+                gevent.sleep(self.debounce)
+            self.wakeup.clear()
+            self.evaluate()
+
+def watchdog_loop(control_greenlet):
+    interval = 5.0
+    if "WATCHDOG_USEC" in os.environ:
+        interval = int(os.environ["WATCHDOG_USEC"]) / 2000000.0
+    while not control_greenlet.dead:
         notify("WATCHDOG=1")
+        before = time.monotonic()
+        gevent.sleep(interval)
+        HUB_LAG_SECONDS.observe(max(0.0, time.monotonic() - before - interval))
+
+DISPATCH_UNKNOWN = "unknown"
+DISPATCH_SKIPPED = "skipped"
+DISPATCH_DECODED = "decoded"
+
+class Zigbee2MQTTDispatch:
+    def __init__(self, logger, mqtt_config, thermostats):
+        self.logger = logger
+        self.prefix = mqtt_config["zigbee2mqtt_topic"]
+        self.birth_topic = mqtt_config.get("birth_topic", "homeassistant/status")
+        # Topics the MQTT client is currently subscribed to
+        self.subscribed = set()
+        self.build(thermostats)
+
+    def build(self, thermostats):
+        # Device topic -> list of (payload key, bound setter, thermostat, field)
+        index = {}
+        for thermostat in thermostats:
+            zb2mqtt = thermostat.get_zigbee2mqtt()
+            if "source" not in zb2mqtt:
+                continue
+            setters = index.setdefault(f"{self.prefix}{zb2mqtt['source']}", [])
+            for k, v in zb2mqtt.items():
+                if k != "source":
+                    setters.append((v, getattr(thermostat, f"set_{k}"), thermostat, k))
+        # Quoted keys to look for in the raw payload before decoding it
+        needles = {topic: [f'"{key}"'.encode() for key, *_ in setters] for topic, setters in index.items()}
+        self.index = index
+        self.needles = needles
+        # Topic -> (received, decoded, skipped, dropped) counters, the label set stays
+        # bounded to the subscribed topics and everything else is counted as "other"
+        self.counters = {topic: self.topic_counters(topic) for topic in [*index, self.birth_topic]}
+        self.other_counters = self.topic_counters("other")
+        # Topic -> last payload bytes seen, identical republishes are not decoded again
+        self.last_payload = {}
+        # Topic -> (thermostat, field, input version once applied) for each value in the last payload
+        self.last_fields = {}
+
+    @staticmethod
+    def topic_counters(label):
+        return (MQTT_RECEIVED.labels(label), MQTT_DECODED.labels(label), MQTT_SKIPPED.labels(label), MQTT_DROPPED.labels(label))
+
+    def topics(self):
+        return list(self.index.keys())
+
+    def dispatch(self, topic, payload):
+        setters = self.index.get(topic)
+        if setters is None:
+            return DISPATCH_UNKNOWN
+
+        now = clock()
+        if self.last_payload.get(topic) == payload:
+            # Decoded again if the API or a schedule changed a field since it was applied,
+            # so the device's own report wins like it did before
+            for thermostat, field, version in self.last_fields[topic]:
+                if thermostat.input_version != version:
+                    break
+            else:
+                # A repeated report still shows the sensor is alive
+                for thermostat, field, _ in self.last_fields[topic]:
+                    thermostat.touch(field, now)
+                return DISPATCH_SKIPPED
+        if not any(needle in payload for needle in self.needles[topic]):
+            self.last_payload[topic] = payload
+            self.last_fields[topic] = ()
+            return DISPATCH_SKIPPED
+
+        payload_decoded = json_loads(payload)
+        if not isinstance(payload_decoded, dict):
+            raise ValueError(f"expected a JSON object on {topic}")
+        fields = []
+        for key, setter, thermostat, field in setters:
+            value = payload_decoded.get(key)
+            if value is not None:
+                setter(value)
+                fields.append((thermostat, field))
+        for thermostat, field in fields:
+            thermostat.touch(field, now)
+        # Only remembered once it has been applied, a failed one is retried next time
+        self.last_payload[topic] = payload
+        self.last_fields[topic] = [(thermostat, field, thermostat.input_version) for thermostat, field in fields]
+        return DISPATCH_DECODED
+
+def mqtt_qos(mqtt_config, message_class):
+    defaults = {"state": 2, "discovery": 2}
+    return int(mqtt_config.get("qos", {}).get(message_class, defaults[message_class]))
+
+class MQTTPublisher:
+    def __init__(self, logger, client, mqtt_config):
+        self.logger = logger
+        self.client = client
+
+        self.state_qos = mqtt_qos(mqtt_config, "state")
+        self.discovery_qos = mqtt_qos(mqtt_config, "discovery")
+        # Unchanged state is still republished after this many seconds
+        self.state_keepalive = float(mqtt_config.get("state_keepalive", 300))
 
+        # Topic -> (last published payload, time published)
+        self.last_state = {}
+
+        # While offline messages wait here, only the latest one per topic is kept
+        self.online = False
+        self.outbox = {}
+        self.outbox_size = int(mqtt_config.get("outbox_size", 256))
+
+        # kind -> (published, published bytes, dropped from the outbox) counters
+        self.counters = {
+            kind: (MQTT_PUBLISHED.labels(kind), MQTT_PUBLISHED_BYTES.labels(kind), MQTT_OUTBOX_DROPPED.labels(kind))
+            for kind in ("state", "discovery")
+        }
+
+    def send(self, kind, topic, payload, qos, retain=False):
+        if not self.online:
+            self.outbox.pop(topic, None)
+            if len(self.outbox) >= self.outbox_size:
+                # Retained discovery outlives any state message, drop the oldest state first
+                oldest = next((t for t, queued in self.outbox.items() if queued[0] == "state"), None)
+                if oldest is None:
+                    oldest = next(iter(self.outbox))
+                self.counters[self.outbox.pop(oldest)[0]][2].inc()
+            self.outbox[topic] = (kind, payload, qos, retain)
+            return
+
+        self.client.publish(topic, payload, qos=qos, retain=retain)
+        published, published_bytes, _ = self.counters[kind]
+        published.inc()
+        published_bytes.inc(len(payload))
+
+    def set_online(self):
+        # Everything queued while offline goes out in one burst
+        outbox, self.outbox = self.outbox, {}
+        self.online = True
+        if outbox:
+            self.logger.info("Sending %d messages queued while offline", len(outbox))
+        for topic, (kind, payload, qos, retain) in outbox.items():
+            self.send(kind, topic, payload, qos, retain)
+
+    def set_offline(self):
+        self.online = False
+
+    def publish_state(self, topic, payload, force=False):
+        now = time.monotonic()
+        if not force and topic in self.last_state:
+            last_payload, last_published = self.last_state[topic]
+            if last_payload == payload and (now - last_published) < self.state_keepalive:
+                return False
+
+        self.send("state", topic, payload, self.state_qos)
+        self.last_state[topic] = (payload, now)
+        return True
+
+    def next_keepalive(self):
+        if not self.last_state:
+            return self.state_keepalive
+        oldest = min(published for _, published in self.last_state.values())
+        return max(0.0, oldest + self.state_keepalive - time.monotonic())
+
+    def publish_discovery(self, topic, payload):
+        self.send("discovery", topic, payload, self.discovery_qos, retain=True)
+
+def publish_discovery_messages(publisher, control_units, thermostats):
+    for control_unit in control_units:
+        control_unit.publish_mqtt_discovery_message(publisher)
+    for thermostat in thermostats:
+        thermostat.publish_mqtt_discovery_message(publisher)
+
+def publish_state_messages(publisher, control_units, thermostats, force=False):
+    for control_unit in control_units:
+        control_unit.publish_mqtt_state_message(publisher, force)
+    for thermostat in thermostats:
+        thermostat.publish_mqtt_state_message(publisher, force)
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties):
+    logger, mqtt_config, control_units, thermostats, dispatch, publisher = userdata
+    if reason_code.is_failure:
+        logger.error("Failed to connect to MQTT server: %s", reason_code)
+        return
+
+    topics = dispatch.topics()
+    if topics:
+        logger.info("Subscribing to topics: %s", ", ".join(topics))
+        client.subscribe([(topic, 0) for topic in topics])
+    dispatch.subscribed = set(topics)
+    client.subscribe(mqtt_config.get("birth_topic", "homeassistant/status"), 0)
+
+    # Discovery is retained, so it only needs to be sent again when the connection comes back.
+    # Both are coalesced with whatever was queued while offline and flushed together.
+    publish_discovery_messages(publisher, control_units, thermostats)
+    publish_state_messages(publisher, control_units, thermostats, force=True)
+    publisher.set_online()
+
+def on_mqtt_disconnect(client, userdata, flags, reason_code, properties):
+    logger, mqtt_config, control_units, thermostats, dispatch, publisher = userdata
+    publisher.set_offline()
+    if reason_code.is_failure:
+        logger.warning("Disconnected from MQTT server: %s", reason_code)
 
 def on_mqtt_message(client, userdata, msg):
-    logger, mqtt_config, control_unit, thermostats = userdata
+    logger, mqtt_config, control_units, thermostats, dispatch, publisher = userdata
+    started = time.perf_counter()
+    received, decoded, skipped, dropped = dispatch.counters.get(msg.topic, dispatch.other_counters)
+    received.inc()
     try:
-        if msg.topic.startswith(mqtt_config["zigbee2mqtt_topic"]):
-            topic_s = msg.topic.split("/")
+        if msg.topic == dispatch.birth_topic:
+            if msg.payload == b"online":
+                logger.info("Home Assistant came online, republishing discovery")
+                publish_discovery_messages(publisher, control_units, thermostats)
+                publish_state_messages(publisher, control_units, thermostats, force=True)
+            return
+
+        result = dispatch.dispatch(msg.topic, msg.payload)
+        if result == DISPATCH_DECODED:
+            decoded.inc()
+        elif result == DISPATCH_SKIPPED:
+            skipped.inc()
+        else:
+            dropped.inc()
+    except ValueError as e:
+        dropped.inc()
+        logger.warning("Malformed payload received from MQTT: %s", e)
+    except Exception as e:
+        dropped.inc()
+        logger.error("Error during MQTT message processing: %s", e)
+    finally:
+        MQTT_HANDLING_SECONDS.observe(time.perf_counter() - started)
+
+class MQTTBridge:
+    def __init__(self, logger, mqtt_config, control_units, thermostats, scheduler):
+        self.logger = logger
+        self.mqtt_config = mqtt_config
+        self.control_units = control_units
+        self.thermostats = thermostats
+
+        global paho
+        import paho.mqtt.client as paho
+
+        self.dispatch = Zigbee2MQTTDispatch(logger, mqtt_config, thermostats)
+        self.client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+        self.publisher = MQTTPublisher(logger, self.client, mqtt_config)
+        self.connect_counters = {result: MQTT_CONNECTS.labels(result) for result in ("success", "failure")}
+        self.client.user_data_set((logger, mqtt_config, control_units, thermostats, self.dispatch, self.publisher))
+        self.client.on_connect = on_mqtt_connect
+        self.client.on_disconnect = on_mqtt_disconnect
+        self.client.on_message = on_mqtt_message
+        # Publishing from other greenlets can leave data waiting for the socket to drain,
+        # this wakes the I/O loop to write it out
+        self.write_wakeup_r, self.write_wakeup_w = os.pipe()
+        os.set_blocking(self.write_wakeup_r, False)
+        os.set_blocking(self.write_wakeup_w, False)
+        self.client.on_socket_register_write = self.on_socket_register_write
+
+        reconnect = mqtt_config.get("reconnect", {})
+        self.reconnect_min = float(reconnect.get("min_delay", 1))
+        self.reconnect_max = float(reconnect.get("max_delay", 120))
+
+        self.state_changed = gevent.event.Event()
+        scheduler.add_listener(self.state_changed.set)
+
+    def update_subscriptions(self):
+        self.dispatch.build(self.thermostats)
+        if not self.client.is_connected():
+            # Everything gets subscribed on connect
+            return
+
+        topics = set(self.dispatch.topics())
+        added = topics - self.dispatch.subscribed
+        removed = self.dispatch.subscribed - topics
+        if added:
+            self.logger.info("Subscribing to topics: %s", ", ".join(added))
+            self.client.subscribe([(topic, 0) for topic in added])
+        if removed:
+            self.logger.info("Unsubscribing from topics: %s", ", ".join(removed))
+            self.client.unsubscribe(list(removed))
+        self.dispatch.subscribed = topics
+
+    def connect(self):
+        mqtt_config = self.mqtt_config
+        self.logger.info("Connecting to MQTT server at %s:%d", mqtt_config["server"], int(mqtt_config["port"]))
+        # Blocks on DNS and TCP, keep it off the hub
+        error = gevent.get_hub().threadpool.apply(self.open_connection)
+        if error:
+            self.connect_counters["failure"].inc()
+            self.logger.warning("Failed to connect to MQTT server: %s", error)
+            return False
+        self.connect_counters["success"].inc()
+        return True
+
+    def open_connection(self):
+        try:
+            self.client.connect(self.mqtt_config["server"], int(self.mqtt_config["port"]), 60)
+        except (OSError, paho.WebsocketConnectionError) as e:
+            return e
+        return None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        try:
+            os.write(self.write_wakeup_w, b"w")
+        except BlockingIOError:
+            # Already pending
+            pass
+
+    def loop(self):
+        # paho's socket is driven from this greenlet instead of a loop_start() thread.
+        # Callbacks run on the hub like everything else, so thermostat state is only
+        # ever touched from one thread and needs no locking.
+        client = self.client
+        rc = paho.MQTT_ERR_SUCCESS
+        while rc == paho.MQTT_ERR_SUCCESS:
+            sock = client.socket()
+            if sock is None:
+                return paho.MQTT_ERR_NO_CONN
+            wlist = [sock] if client.want_write() else []
+            readable, writable, _ = gevent.select.select([sock, self.write_wakeup_r], wlist, [], 1.0)
+            if self.write_wakeup_r in readable:
+                try:
+                    os.read(self.write_wakeup_r, 512)
+                except BlockingIOError:
+                    pass
+            if sock in readable:
+                rc = client.loop_read()
+            if rc == paho.MQTT_ERR_SUCCESS and (writable or client.want_write()):
+                rc = client.loop_write()
+            if rc == paho.MQTT_ERR_SUCCESS:
+                rc = client.loop_misc()
+        return rc
+
+    def maintain_connection(self):
+        mqtt_config = self.mqtt_config
+        self.client.username_pw_set(mqtt_config["username"], mqtt_config["password"])
+        delay = self.reconnect_min
+        while True:
+            if self.connect():
+                rc = self.loop()
+                if self.publisher.online:
+                    # It was a working session, start over with short delays
+                    delay = self.reconnect_min
+                self.publisher.set_offline()
+                self.logger.warning("Lost connection to MQTT server: %s", paho.error_string(rc))
+
+            # Jittered so clients restarting together do not hammer the broker in lockstep
+            wait = random.uniform(delay / 2, delay)
+            self.logger.info("Reconnecting to MQTT server in %.1f s", wait)
+            gevent.sleep(wait)
+            delay = min(delay * 2, self.reconnect_max)
+
+    def run(self):
+        connection_greenlet = gevent.spawn(self.maintain_connection)
+        connection_greenlet.link_exception(lambda g: self.logger.error("MQTT connection handling failed: %s", g.exception))
+        while True:
+            self.state_changed.wait(self.publisher.next_keepalive())
+            self.state_changed.clear()
+            # Only changed states (or ones due for a keepalive) are actually sent
+            publish_state_messages(self.publisher, self.control_units, self.thermostats)
+
+class StartupProfile:
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        # (phase, seconds) in the order they finished
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+        return now - self.started
+
+    def report(self):
+        lines = ["%-28s %8.1f ms" % (phase, seconds * 1000) for phase, seconds in self.phases]
+        lines.append("%-28s %8.1f ms" % ("total", (self.last - self.started) * 1000))
+        return "\n".join(lines)
+
+def load_config(path):
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=yaml.SafeLoader)
+
+def unit_configs(config):
+    # One config per control unit, each shaped like a single unit config
+    if "units" not in config:
+        return [config]
+    configs = []
+    for unit in config["units"]:
+        unit_config = {key: value for key, value in config.items() if key != "units"}
+        unit_config.update(unit)
+        unit_config["control"] = dict(config.get("control", {}), **unit.get("control", {}))
+        unit_id = unit_config["control"].get("id")
+        # Rooms and MQTT entities of different units must not collide
+        unit_config["namespace"] = unit_id
+        state = unit_config.get("state", {})
+        if "state" not in unit and state.get("path"):
+            root, ext = os.path.splitext(state["path"])
+            unit_config["state"] = dict(state, path=f"{root}.{unit_id}{ext}")
+        configs.append(unit_config)
+    return configs
+
+def unit_relay_gpios(config):
+    relay_gpios = [config["control"]["heat_relay_gpio"], config["control"]["cool_relay_gpio"]]
+    relay_gpios += [room["relay_gpio"] for room in config["rooms"]]
+    return relay_gpios
+
+def validate_config(config):
+    if "units" not in config:
+        return validate_unit_config(config)
+    if not isinstance(config["units"], list) or not config["units"]:
+        return ["units: must be a non-empty list"]
+
+    errors = []
+    unit_ids = set()
+    # (gpio chip, relay line) -> index of the unit using it, a line can only be requested once
+    relay_lines = {}
+    configs = unit_configs(config)
+    for i, unit_config in enumerate(configs):
+        unit_errors = validate_unit_config(unit_config)
+        errors += [f"units[{i}]: {error}" for error in unit_errors]
+        if not unit_errors:
+            for gpio in set(unit_relay_gpios(unit_config)):
+                line = (unit_config.get("gpio_chip"), gpio)
+                if line in relay_lines:
+                    errors.append(f"units[{i}]: relay {gpio} on {line[0]} is also used by units[{relay_lines[line]}]")
+                relay_lines.setdefault(line, i)
+        unit_id = unit_config["control"].get("id")
+        if unit_id in unit_ids:
+            errors.append(f"units[{i}]: duplicate control id {unit_id}")
+        unit_ids.add(unit_id)
+        # All units share one control scheduler
+        if unit_config["control"].get("debounce") != configs[0]["control"].get("debounce"):
+            errors.append(f"units[{i}]: control debounce differs from the first unit, it is shared by all units")
+    return errors
+
+def validate_unit_config(config):
+    errors = []
+    for section in ("mqtt", "control", "rooms"):
+        if section not in config:
+            errors.append(f"missing section: {section}")
+    if errors:
+        return errors
+
+    for key in ("server", "port", "username", "password", "discovery_topic", "state_topic", "zigbee2mqtt_topic"):
+        if key not in config["mqtt"]:
+            errors.append(f"mqtt: missing {key}")
+    for key in ("id", "name", "manufacturer", "model", "mode_preference", "min_cycle_duration", "valve_min_cycle_duration",
+                "cold_tolerance", "heat_tolerance", "initial_temperature", "max_temperature", "min_temperature",
+                "heat_relay_gpio", "cool_relay_gpio"):
+        if key not in config["control"]:
+            errors.append(f"control: missing {key}")
+    for key in ("min_cycle_duration", "valve_min_cycle_duration", "changeover_dead_time", "debounce",
+                "cold_tolerance", "heat_tolerance", "initial_temperature", "max_temperature", "min_temperature",
+                "off_temperature", "stale_after", "stale_max_heat"):
+        if key in config["control"]:
+            try:
+                float(config["control"][key])
+            except (TypeError, ValueError):
+                errors.append(f"control: {key} is not a number")
+    if config["control"].get("mode_preference") not in (MODE_HEAT, MODE_COOL, MODE_OFF):
+        errors.append("control: mode_preference must be HEAT, COOL or OFF")
+    stale_action = config["control"].get("stale_action", STALE_CLOSE)
+    if stale_action not in (STALE_CLOSE, STALE_OFF_TEMPERATURE):
+        errors.append("control: stale_action must be close or off_temperature")
+    elif stale_action == STALE_OFF_TEMPERATURE and "off_temperature" not in config["control"]:
+        errors.append("control: stale_action off_temperature needs off_temperature")
+
+    room_ids = set()
+    for i, room in enumerate(config["rooms"]):
+        if "id" not in room:
+            errors.append(f"rooms[{i}]: missing id")
+            continue
+        if room["id"] in room_ids:
+            errors.append(f"rooms[{i}]: duplicate id {room['id']}")
+        if len(str(room["id"]).encode()) > StateSnapshot.max_id_bytes:
+            errors.append(f"rooms[{i}]: id {room['id']} is longer than {StateSnapshot.max_id_bytes} bytes")
+        room_ids.add(room["id"])
+        for key in ("name", "relay_gpio"):
+            if key not in room:
+                errors.append(f"rooms[{i}]: missing {key}")
+        if "stale_after" in room:
             try:
-                payload_decoded = json.loads(msg.payload)
-                for thermostat in thermostats:
-                    zb2mqtt = thermostat.get_zigbee2mqtt() 
-                    if "source" in zb2mqtt:
-                        if topic_s[1] == zb2mqtt["source"]:
-                            for k, v in zb2mqtt.items():
-                                if k != "source" and v in payload_decoded:
-                                    getattr(thermostat, f"set_{k}")(payload_decoded[v])
+                float(room["stale_after"])
+            except (TypeError, ValueError):
+                errors.append(f"rooms[{i}]: stale_after is not a number")
+        if "schedule" in room:
+            try:
+                SetpointSchedule(room["schedule"])
+            except (TypeError, ValueError) as e:
+                errors.append(f"rooms[{i}]: invalid schedule: {e}")
+        for k in room.get("zigbee2mqtt", {}):
+            if k != "source" and not hasattr(Thermostat, f"set_{k}"):
+                errors.append(f"rooms[{i}]: unknown zigbee2mqtt field {k}")
+    bypass_room = config["control"].get("bypass_room")
+    if bypass_room is not None and bypass_room not in room_ids:
+        errors.append(f"control: bypass_room {bypass_room} is not a room")
+    return errors
+
+class Controller:
+    # One control unit with its own GPIO chip, relays, rooms and state snapshot
+    def __init__(self, logger, config, open_gpio=True):
+        self.logger = logger
+        self.config = config
+        self.id = config["control"]["id"]
+
+        # Without the chip the relays are only logged, for --profile-startup
+        gpio_chip = None
+        if open_gpio:
+            try:
+                gpio_chip = gpiod.Chip(config["gpio_chip"])
+
             except Exception as e:
-                logger.warning("Malformed payload received from MQTT: %s" % (str(e)))
-    except Exception as e:
-        logger.error("Error during MQTT message processing: %s" % (str(e)))
+                logger.fatal("Failed to open GPIO chip: %s: %s", config.get("gpio_chip"), e)
+                # sys.exit(1)
 
-def mqtt_loop(logger, mqtt_config, control_unit, thermostats):
-    client = paho.Client(paho.CallbackAPIVersion.VERSION2)
-    client.user_data_set((logger, mqtt_config, control_unit, thermostats))
-    client.on_message = on_mqtt_message
-    
-    logger.info("Connecting to MQTT server at %s:%d" % (mqtt_config["server"], int(mqtt_config["port"])))
-    client.username_pw_set(mqtt_config["username"], mqtt_config["password"])
-    client.connect(mqtt_config["server"], int(mqtt_config["port"]), 60)
-    logger.info("Subscribing to topic: %s#" % (mqtt_config["zigbee2mqtt_topic"]))
-    client.subscribe(f"{mqtt_config['zigbee2mqtt_topic']}#", 0)
+        gpio_reverse = False
+        if "gpio_reverse" in config:
+            gpio_reverse = config["gpio_reverse"]
 
-    control_unit.publish_mqtt_discovery_message(client)
-    for thermostat in thermostats:
-        thermostat.publish_mqtt_discovery_message(client)
-
-    loop = 0
-    before_loop = time.monotonic()
-    client.loop_start()
-    while True:
-        gevent.sleep(1)
-        after_loop = time.monotonic()
-        if (after_loop - before_loop) >= 1.0:
-            before_loop = after_loop
-            loop = loop + 1
-            if loop % 3 == 0:
-                # publish state messages
-                control_unit.publish_mqtt_state_message(client)
-                for thermostat in thermostats:
-                    thermostat.publish_mqtt_state_message(client)
-            if loop == 10:
-                # Publish discovery messages
-                control_unit.publish_mqtt_discovery_message(client)
-                for thermostat in thermostats:
-                    thermostat.publish_mqtt_discovery_message(client)
-                loop = 0
+        snapshot = StateSnapshot.load(logger, config.get("state", {}))
+        self.relays = RelayBank(logger, gpio_chip, unit_relay_gpios(config), gpio_reverse, StateSnapshot.relay_states(snapshot, config))
 
-if __name__ == "__main__":
-    logger = logging.getLogger(__name__)
-    logging.basicConfig(level=logging.DEBUG)
+        self.control_unit = ControlUnit(logger, config, self.relays)
+        self.thermostats = ThermostatRegistry(Thermostat(logger, self.control_unit, config, room) for room in config["rooms"])
+        self.state_snapshot = StateSnapshot(logger, self.control_unit, self.thermostats, config.get("state", {}))
+        if snapshot:
+            self.state_snapshot.restore(snapshot)
 
-    config = {}
-    with open(sys.argv[1], "r") as f:
-        config = yaml.load(f, Loader=yaml.SafeLoader)
+        # Created once control is running
+        self.state_stream = None
+        self.history_recorder = None
 
-    try:
-        GPIOCHIP = gpiod.Chip(config["gpio_chip"])
+class ConfigReloader:
+    # Changes to these need a restart to take effect
+    restart_keys = ("mqtt", "http", "gpio_chip", "gpio_reverse", "state", "history", "display")
+    restart_control_keys = ("id", "heat_relay_gpio", "cool_relay_gpio", "initial_temperature")
 
-    except Exception as e:
-        logger.fatal(f"Failed to open GPIO chip: {config['gpio_chip']}: {e}")
-        # sys.exit(1)
+    def __init__(self, logger, path, config, controllers, thermostats, scheduler, schedule_runner, stale_monitor, mqtt_bridge):
+        self.logger = logger
+        self.path = path
+        self.config = config
+        self.controllers = controllers
+        # Thermostats of all units, shared with the scheduler, schedule runner and MQTT bridge
+        self.thermostats = thermostats
+        self.scheduler = scheduler
+        self.schedule_runner = schedule_runner
+        self.stale_monitor = stale_monitor
+        self.mqtt_bridge = mqtt_bridge
+
+        self.watch_interval = float(config.get("reload", {}).get("watch_interval", 0))
+        self.mtime = self.config_mtime()
+        self.requested = gevent.event.Event()
+
+    def config_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def request(self):
+        self.requested.set()
+
+    def run(self):
+        while True:
+            self.requested.wait(self.watch_interval if self.watch_interval > 0 else None)
+            if self.requested.is_set():
+                self.requested.clear()
+                self.reload()
+            elif self.config_mtime() != self.mtime:
+                self.reload()
+
+    def reload(self):
+        self.mtime = self.config_mtime()
+        self.logger.info("Reloading configuration from %s", self.path)
+        try:
+            config = load_config(self.path)
+        except (OSError, yaml.YAMLError) as e:
+            self.logger.error("Failed to read configuration, keeping the running one: %s", e)
+            return
+        errors = validate_config(config)
+        if errors:
+            self.logger.error("Invalid configuration, keeping the running one: %s", "; ".join(errors))
+            return
+
+        new_units = unit_configs(config)
+        if [controller.id for controller in self.controllers] != [unit["control"]["id"] for unit in new_units]:
+            self.logger.error("Adding or removing control units needs a restart, keeping the running configuration")
+            return
+
+        if "logging" in config and self.config.get("logging") != config["logging"]:
+            logging.getLogger().setLevel(logging.getLevelName(str(config["logging"].get("level", "INFO")).upper()))
+
+        changed = []
+        removed = []
+        for controller, unit_config in zip(self.controllers, new_units):
+            result = self.reload_unit(controller, unit_config)
+            if result is None:
+                # This unit keeps running its old config, the others are still applied
+                continue
+            changed += result[0]
+            removed += result[1]
+
+        self.scheduler.debounce = float(self.controllers[0].config["control"].get("debounce", 0.05))
+        self.thermostats[:] = [thermostat for controller in self.controllers for thermostat in controller.thermostats]
+        self.scheduler.set_thermostats(self.thermostats)
+        self.schedule_runner.wakeup.set()
+        self.stale_monitor.set_thermostats(self.thermostats)
+        for thermostat in changed:
+            self.scheduler.mark_dirty(thermostat)
+
+        self.mqtt_bridge.update_subscriptions()
+        publisher = self.mqtt_bridge.publisher
+        if self.mqtt_bridge.client.is_connected():
+            for thermostat in removed:
+                # An empty retained config removes the entity from Home Assistant
+                publisher.publish_discovery(thermostat.mqtt_discovery_topic, b"")
+            for thermostat in changed:
+                thermostat.publish_mqtt_discovery_message(publisher)
 
-    if "gpio_reverse" in config:
-        GPIOREVERSE = config["gpio_reverse"]
+        self.config = config
+        self.logger.info("Configuration reloaded")
+
+    def reload_unit(self, controller, config):
+        # Returns the changed and removed thermostats, None if the unit kept its running config
+        old = controller.config
+        for key in self.restart_keys:
+            if old.get(key) != config.get(key):
+                self.logger.warning("Change to %s needs a restart, keeping the running value", key)
+                config[key] = old.get(key)
+        for key in self.restart_control_keys:
+            if old["control"].get(key) != config["control"].get(key):
+                self.logger.warning("Change to control.%s needs a restart, keeping the running value", key)
+                config["control"][key] = old["control"].get(key)
+
+        old_rooms = {room["id"]: room for room in old["rooms"]}
+        new_rooms = {room["id"]: room for room in config["rooms"]}
+        added = [room_id for room_id in new_rooms if room_id not in old_rooms]
+        removed = [room_id for room_id in old_rooms if room_id not in new_rooms]
+
+        # Request new relay lines first, if that fails nothing has been touched yet
+        relay_gpios = unit_relay_gpios(config)
+        try:
+            controller.relays.add_lines(relay_gpios)
+        except Exception as e:
+            self.logger.error("Failed to request relay lines of %s, keeping its running configuration: %s", controller.id, e)
+            return None
+
+        control_unit = controller.control_unit
+        discovery_version = control_unit.discovery_version
+        control_unit.apply_config(config)
+        controller.relays.commit()
+        controller.relays.remove_lines([gpio for gpio in controller.relays.states if gpio not in relay_gpios])
+        if control_unit.discovery_version != discovery_version and self.mqtt_bridge.client.is_connected():
+            control_unit.publish_mqtt_discovery_message(self.mqtt_bridge.publisher)
+
+        changed = []
+        removed_thermostats = [thermostat for thermostat in controller.thermostats if thermostat.id in removed]
+        for thermostat in removed_thermostats:
+            thermostat.on_change = None
+        thermostats = {thermostat.id: thermostat for thermostat in controller.thermostats}
+        for room_id, room in new_rooms.items():
+            if room_id in thermostats:
+                if thermostats[room_id].apply_config(config, room):
+                    changed.append(thermostats[room_id])
+            else:
+                thermostat = Thermostat(self.logger, control_unit, config, room)
+                if controller.history_recorder:
+                    controller.history_recorder.attach(thermostat)
+                thermostats[room_id] = thermostat
+                changed.append(thermostat)
+        controller.thermostats.replace([thermostats[room_id] for room_id in new_rooms])
+        controller.config = config
 
-    control_unit = ControlUnit(logger, config)
-    thermostats = [Thermostat(logger, control_unit, config, room) for room in config["rooms"]]
+        self.logger.info("Configuration of %s reloaded: %d rooms added, %d removed, %d changed", controller.id, len(added), len(removed), len(changed) - len(added))
+        return changed, removed_thermostats
 
-    app = Flask(__name__)
-    WebAPI.register(app, route_base="/", init_argument=(control_unit))
-    ThermostatAPI.register(app, route_base="/thermostats", init_argument=(thermostats))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zigbee2MQTT thermostat connector")
+    parser.add_argument("config", help="Path to thermostat.yaml")
+    parser.add_argument("--profile-startup", action="store_true", help="Report how long each startup phase took and exit")
+    args = parser.parse_args()
 
-    http_server = WSGIServer(('', 8080), app)
-    srv_greenlet = gevent.spawn(http_server.serve_forever)
-    mqtt_greenlet = gevent.spawn(mqtt_loop, logger, config["mqtt"], control_unit, thermostats)
-    control_greenlet = gevent.spawn(control_loop, control_unit, thermostats)
+    profile = StartupProfile(IMPORTS_STARTED)
+    profile.mark("core imports")
+    logger = logging.getLogger(__name__)
 
-    try:
+    config = load_config(args.config)
+    errors = validate_config(config)
+    if errors:
+        logging.basicConfig()
+        logger.fatal("Invalid configuration: %s", "; ".join(errors))
+        sys.exit(1)
+
+    log_listener = setup_logging(config.get("logging", {}))
+    profile.mark("config and logging")
+
+    # Only imports and constructs everything: no GPIO lines, no notify, no network
+    profiling = args.profile_startup
+
+    # Stage 1: relays restored and control running, nothing else is needed for that
+    controllers = [Controller(logger, unit_config, open_gpio=not profiling) for unit_config in unit_configs(config)]
+    control_units = [controller.control_unit for controller in controllers]
+    # Room ids only have to be unique within a unit, this list is for the shared services
+    thermostats = [thermostat for controller in controllers for thermostat in controller.thermostats]
+    profile.mark("relays")
+
+    schedule_runner = ScheduleRunner(logger, thermostats)
+    stale_monitor = StaleSensorMonitor(logger, thermostats)
+    scheduler = ControlScheduler(logger, control_units, thermostats, float(controllers[0].config["control"].get("debounce", 0.05)))
+    if not profiling:
+        for controller in controllers:
+            scheduler.add_listener(controller.state_snapshot.update)
+    # The first control pass, before anything else is started or even imported
+    scheduler.evaluate()
+    greenlets = []
+    if not profiling:
+        control_greenlet = gevent.spawn(scheduler.run)
+        greenlets.append(control_greenlet)
+        greenlets.append(gevent.spawn(watchdog_loop, control_greenlet))
+        gevent.spawn(schedule_runner.run)
+        gevent.spawn(stale_monitor.run)
+        # Lets the watchdog start before the slower stages
+        gevent.sleep(0)
+    logger.info("Control active %.0f ms after start", profile.mark("control") * 1000)
+    if not profiling:
         notify("READY=1")
-        gevent.joinall([srv_greenlet, control_greenlet, mqtt_greenlet])
+
+    # Stage 2: MQTT, one connection for all units
+    mqtt_bridge = MQTTBridge(logger, config["mqtt"], control_units, thermostats, scheduler)
+    if not profiling:
+        greenlets.append(gevent.spawn(mqtt_bridge.run))
+    profile.mark("mqtt")
+
+    # Stage 3: web API, history and the optional subsystems
+    for controller in controllers:
+        controller.state_stream = StateStream(logger, controller.control_unit, controller.thermostats)
+        scheduler.add_listener(controller.state_stream.update)
+    from gevent.pywsgi import WSGIServer
+    import webapi
+    profile.mark("import web stack")
+
+    app = webapi.create_app(controllers, schedule_runner, METRICS)
+    # Bound once it is started
+    http_server = WSGIServer(('', int(config.get("http", {}).get("port", 8080))), app)
+    if not profiling:
+        greenlets.append(gevent.spawn(http_server.serve_forever))
+    profile.mark("web server")
+
+    for controller in controllers:
+        controller.history_recorder = HistoryRecorder(logger, controller.control_unit, controller.thermostats, controller.config.get("history", {}))
+        if not profiling:
+            gevent.spawn(controller.history_recorder.run)
+    profile.mark("history")
+
+    if config.get("display", {}).get("enabled", False):
+        display_config = config["display"]
+        if profiling:
+            # Same libraries and rendering, without touching the bus
+            display_config = dict(display_config, driver="dummy")
+        # The display only has room for one unit
+        try:
+            display = Display(logger, controllers[0].control_unit, controllers[0].thermostats, display_config)
+            scheduler.add_listener(display.update)
+            if not profiling:
+                gevent.spawn(display.run)
+        except Exception as e:
+            logger.error("Failed to open display: %s", e)
+        profile.mark("display")
+
+    reloader = ConfigReloader(logger, args.config, config, controllers, thermostats, scheduler, schedule_runner, stale_monitor, mqtt_bridge)
+    if not profiling:
+        gevent.signal_handler(signal.SIGHUP, reloader.request)
+        gevent.spawn(reloader.run)
+    profile.mark("config reload")
+
+    try:
+        if profiling:
+            print(profile.report(), file=sys.stderr)
+        else:
+            gevent.joinall(greenlets)
     except KeyboardInterrupt:
+        pass
+    if http_server.started:
         http_server.stop()
-        logger.warning("Exiting...")
+    for controller in controllers:
+        controller.relays.close()
+    logger.warning("Exiting...")
+    log_listener.stop()
@@ -0,0 +1,44 @@
+# Setpoint parsing and daily schedules, shared by the control loop and the web API
+import math
+from array import array
+from bisect import bisect_right
+
+def parse_time_of_day(value):
+    hours, minutes = (int(part) for part in str(value).split(":"))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"time of day out of range: {value}")
+    return hours * 60 + minutes
+
+def parse_setpoint(value):
+    setpoint = float(value)
+    if not math.isfinite(setpoint):
+        raise ValueError(f"setpoint is not a finite number: {value}")
+    return setpoint
+
+class SetpointSchedule:
+    __slots__ = ("minutes", "setpoints")
+
+    def __init__(self, transitions):
+        # Minutes since midnight and the setpoint from then on, sorted by time of day
+        pairs = sorted((parse_time_of_day(at), parse_setpoint(setpoint)) for at, setpoint in transitions)
+        if not pairs:
+            raise ValueError("a schedule needs at least one transition")
+        self.minutes = array("H", [minute for minute, _ in pairs])
+        self.setpoints = array("f", [setpoint for _, setpoint in pairs])
+        if len(set(self.minutes)) != len(self.minutes):
+            raise ValueError("a schedule has two transitions at the same time")
+
+    def active(self, minute):
+        # Before the first transition of the day the last one of the previous day is in effect
+        return (bisect_right(self.minutes, minute) - 1) % len(self.minutes)
+
+    def setpoint(self, index):
+        return round(self.setpoints[index], 2)
+
+    def minutes_until_next(self, minute):
+        i = bisect_right(self.minutes, minute)
+        next_minute = self.minutes[i] if i < len(self.minutes) else self.minutes[0] + 24 * 60
+        return next_minute - minute
+
+    def to_list(self):
+        return [["%02d:%02d" % divmod(minute, 60), self.setpoint(i)] for i, minute in enumerate(self.minutes)]
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# Offline simulation and benchmark harness for the control logic. Runs the real
+# Thermostat/ControlUnit/ControlScheduler code against a recording relay bank and a
+# simple per-room thermal model on virtual time, or replays recorded zigbee2mqtt traces.
+#
+#   python3 simulate.py thermostat.yaml --hours 24
+#   python3 simulate.py thermostat.yaml --trace trace.jsonl --json
+#
+# Trace files have one JSON object per line: {"t": <seconds from start>, "topic": ..., "payload": ...}
+import argparse
+import copy
+import json
+import logging
+import math
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import yaml
+
+import main
+
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingRelayBank(main.RelayBank):
+    def __init__(self, logger, gpios, clock):
+        super().__init__(logger, None, gpios)
+        self.clock = clock
+        self.switches = {gpio: 0 for gpio in self.states}
+        self.last_switched = {gpio: None for gpio in self.states}
+        self.shortest_cycle = {gpio: None for gpio in self.states}
+        self.writes = 0
+
+    def commit(self):
+        # Recorded before RelayBank applies and counts them
+        changes = [gpio for gpio, state in self.pending.items() if self.states[gpio] != state]
+        if changes:
+            now = self.clock()
+            self.writes += 1
+            for gpio in changes:
+                self.switches[gpio] += 1
+                if self.last_switched[gpio] is not None:
+                    cycle = now - self.last_switched[gpio]
+                    if self.shortest_cycle[gpio] is None or cycle < self.shortest_cycle[gpio]:
+                        self.shortest_cycle[gpio] = cycle
+                self.last_switched[gpio] = now
+        return super().commit()
+
+
+class RoomModel:
+    def __init__(self, temperature, outdoor, time_constant, heat_rate, cool_rate):
+        self.temperature = temperature
+        self.outdoor = outdoor
+        # Hours for the room to drift ~63% of the way to the outdoor temperature
+        self.time_constant = time_constant * 3600.0
+        # Degrees per hour the heating or cooling adds on top of the losses
+        self.heat_rate = heat_rate / 3600.0
+        self.cool_rate = cool_rate / 3600.0
+
+    def step(self, dt, heating, cooling):
+        power = 0.0
+        if heating:
+            power += self.heat_rate
+        if cooling:
+            power -= self.cool_rate
+        # Exact solution for constant power over the step
+        equilibrium = self.outdoor + power * self.time_constant
+        self.temperature = equilibrium + (self.temperature - equilibrium) * math.exp(-dt / self.time_constant)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+class Simulation:
+    def __init__(self, logger, config, args):
+        self.logger = logger
+        self.args = args
+        self.clock = VirtualClock()
+        main.clock = self.clock
+        main.logger = logger
+
+        self.config = copy.deepcopy(config)
+        self.trace = []
+        if args.trace:
+            with open(args.trace, "r") as f:
+                for line in f:
+                    if line.strip():
+                        self.trace.append(json.loads(line))
+            self.trace.sort(key=lambda event: event["t"])
+        else:
+            # Every room gets its own virtual sensor so the models are independent
+            for room in self.config["rooms"]:
+                zb2mqtt = room.setdefault("zigbee2mqtt", {"current_temp": "local_temperature"})
+                zb2mqtt["source"] = f"sim_{room['id']}"
+
+        control = self.config["control"]
+        self.relays = RecordingRelayBank(logger, main.unit_relay_gpios(self.config), self.clock)
+
+        self.control_unit = main.ControlUnit(logger, self.config, self.relays)
+        self.thermostats = [main.Thermostat(logger, self.control_unit, self.config, room) for room in self.config["rooms"]]
+        self.scheduler = main.ControlScheduler(logger, [self.control_unit], self.thermostats, float(control.get("debounce", 0.05)))
+        self.dispatch = main.Zigbee2MQTTDispatch(logger, self.config["mqtt"], self.thermostats)
+        self.userdata = (logger, self.config["mqtt"], [self.control_unit], self.thermostats, self.dispatch, None)
+
+        self.models = {}
+        if not self.trace:
+            for thermostat in self.thermostats:
+                if args.setpoint is not None:
+                    thermostat.set_target_temp(args.setpoint)
+                self.models[thermostat.id] = RoomModel(
+                    args.initial_temperature, args.outdoor, args.time_constant, args.heat_rate, args.cool_rate
+                )
+
+        self.tick_durations = []
+        self.comfort_error = {thermostat.id: 0.0 for thermostat in self.thermostats}
+        self.comfort_outside_band = {thermostat.id: 0.0 for thermostat in self.thermostats}
+
+    def room_temperature(self, thermostat):
+        if thermostat.id in self.models:
+            return self.models[thermostat.id].temperature
+        return thermostat.current_temp
+
+    def advance(self, until):
+        dt = until - self.clock.now
+        if dt <= 0:
+            return
+
+        heat_on = self.relays.states[self.control_unit.heat_gpio]
+        cool_on = self.relays.states[self.control_unit.cool_gpio]
+        for thermostat in self.thermostats:
+            temperature = self.room_temperature(thermostat)
+            error = abs(temperature - thermostat.target_temp)
+            self.comfort_error[thermostat.id] += error * dt
+            band = max(thermostat.cold_tolerance, thermostat.heat_tolerance)
+            if error > band:
+                self.comfort_outside_band[thermostat.id] += (error - band) * dt
+
+            if thermostat.id in self.models:
+                valve_open = self.relays.states[self.control_unit.room_index[thermostat.id].gpio]
+                self.models[thermostat.id].step(dt, heat_on and valve_open, cool_on and valve_open)
+        self.clock.now = until
+
+    def deliver(self, topic, payload):
+        if not isinstance(payload, (bytes, str)):
+            payload = json.dumps(payload)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        main.on_mqtt_message(None, self.userdata, SimpleNamespace(topic=topic, payload=payload))
+
+    def report_sensor(self, thermostat):
+        zb2mqtt = thermostat.get_zigbee2mqtt()
+        payload = {}
+        if "current_temp" in zb2mqtt:
+            payload[zb2mqtt["current_temp"]] = round(self.models[thermostat.id].temperature, 1)
+        if "target_temp" in zb2mqtt:
+            payload[zb2mqtt["target_temp"]] = thermostat.target_temp
+        self.deliver(f"{self.config['mqtt']['zigbee2mqtt_topic']}{zb2mqtt['source']}", payload)
+
+    def evaluate(self):
+        started = time.perf_counter()
+        self.scheduler.evaluate()
+        self.tick_durations.append(time.perf_counter() - started)
+
+    def run(self):
+        duration = self.args.hours * 3600.0
+        if self.trace:
+            duration = max(duration, self.trace[-1]["t"])
+
+        # Stagger the sensors so they do not all report in the same instant
+        next_report = {}
+        for k, thermostat in enumerate(self.thermostats):
+            if thermostat.id in self.models:
+                next_report[thermostat.id] = k * self.args.report_interval / max(1, len(self.models))
+        trace_index = 0
+        evaluate_at = 0.0
+
+        started = time.perf_counter()
+        while True:
+            candidates = [duration]
+            candidates.extend(next_report.values())
+            if trace_index < len(self.trace):
+                candidates.append(self.trace[trace_index]["t"])
+            if evaluate_at is not None:
+                candidates.append(evaluate_at)
+            if self.scheduler.next_deadline is not None:
+                candidates.append(self.scheduler.next_deadline)
+            now = max(self.clock.now, min(candidates))
+            if now >= duration:
+                self.advance(duration)
+                break
+            self.advance(now)
+
+            for thermostat in self.thermostats:
+                if next_report.get(thermostat.id, duration) <= now:
+                    self.report_sensor(thermostat)
+                    next_report[thermostat.id] = now + self.args.report_interval
+            while trace_index < len(self.trace) and self.trace[trace_index]["t"] <= now:
+                event = self.trace[trace_index]
+                self.deliver(event["topic"], event["payload"])
+                trace_index += 1
+
+            # Same debounce and deadline behaviour as ControlScheduler.run
+            if self.scheduler.dirty and evaluate_at is None:
+                evaluate_at = now + self.scheduler.debounce
+            deadline_due = self.scheduler.next_deadline is not None and self.scheduler.next_deadline <= now
+            if (evaluate_at is not None and evaluate_at <= now) or deadline_due:
+                evaluate_at = None
+                self.evaluate()
+        wall = time.perf_counter() - started
+
+        return self.report(duration, wall)
+
+    def report(self, duration, wall):
+        hours = duration / 3600.0
+        relays = {}
+        for gpio, switches in self.relays.switches.items():
+            relays[gpio] = {
+                "switches": switches,
+                "switches_per_hour": round(switches / hours, 2) if hours else 0,
+                "shortest_cycle_s": self.relays.shortest_cycle[gpio],
+            }
+        comfort = {}
+        for thermostat in self.thermostats:
+            comfort[thermostat.id] = {
+                "mean_abs_error_c": round(self.comfort_error[thermostat.id] / duration, 3) if duration else 0,
+                "degree_hours_outside_band": round(self.comfort_outside_band[thermostat.id] / 3600.0, 3),
+                "final_temperature_c": round(self.room_temperature(thermostat), 2),
+            }
+        ticks = [d * 1e6 for d in self.tick_durations]
+        return {
+            "simulated_hours": round(hours, 2),
+            "wall_seconds": round(wall, 3),
+            "speedup": round(duration / wall) if wall else None,
+            "control_ticks": len(ticks),
+            "tick_latency_us": {
+                "p50": round(percentile(ticks, 50), 1),
+                "p90": round(percentile(ticks, 90), 1),
+                "p99": round(percentile(ticks, 99), 1),
+                "max": round(max(ticks), 1) if ticks else 0.0,
+                "mean": round(statistics.fmean(ticks), 1) if ticks else 0.0,
+            },
+            "relay_writes": self.relays.writes,
+            "relays": relays,
+            "comfort": comfort,
+        }
+
+
+def benchmark_mqtt(logger, config, count):
+    sim = Simulation(logger, config, SimpleNamespace(
+        trace=None, setpoint=None, initial_temperature=20.0, outdoor=5.0,
+        time_constant=10.0, heat_rate=2.0, cool_rate=2.0,
+    ))
+    prefix = sim.config["mqtt"]["zigbee2mqtt_topic"]
+    ours = []
+    for k in range(count):
+        thermostat = sim.thermostats[k % len(sim.thermostats)]
+        zb2mqtt = thermostat.get_zigbee2mqtt()
+        payload = {
+            zb2mqtt["current_temp"]: 18.0 + (k % 50) / 10.0,
+            "battery": 87,
+            "linkquality": 120,
+        }
+        ours.append(SimpleNamespace(topic=f"{prefix}{zb2mqtt['source']}", payload=json.dumps(payload).encode()))
+    foreign = [
+        SimpleNamespace(topic=f"{prefix}Some other device {k % 200}", payload=b'{"state": "ON", "linkquality": 90}')
+        for k in range(count)
+    ]
+
+    # The same report over and over, as chatty TRVs do
+    repeated = [ours[k % len(sim.thermostats)] for k in range(count)]
+
+    ret = {}
+    for name, messages in (("handled", ours), ("repeated", repeated), ("foreign", foreign)):
+        started = time.perf_counter()
+        for msg in messages:
+            main.on_mqtt_message(None, sim.userdata, msg)
+        elapsed = time.perf_counter() - started
+        ret[name] = {"messages": count, "messages_per_second": round(count / elapsed) if elapsed else None}
+    return ret
+
+
+def print_report(report):
+    print(f"Simulated {report['simulated_hours']} h in {report['wall_seconds']} s ({report['speedup']}x)")
+    print(f"Control ticks: {report['control_ticks']}, relay writes: {report['relay_writes']}")
+    latency = report["tick_latency_us"]
+    print(f"Tick latency (us): p50 {latency['p50']}  p90 {latency['p90']}  p99 {latency['p99']}  max {latency['max']}")
+    print("Relays:")
+    for gpio, relay in report["relays"].items():
+        print(f"  {gpio:<16} {relay['switches']:>6} switches  {relay['switches_per_hour']:>7}/h  shortest cycle {relay['shortest_cycle_s']}")
+    print("Comfort:")
+    for room_id, comfort in report["comfort"].items():
+        print(f"  {room_id:<16} mean error {comfort['mean_abs_error_c']} C  outside band {comfort['degree_hours_outside_band']} Ch  final {comfort['final_temperature_c']} C")
+    if "mqtt" in report:
+        print("MQTT handler:")
+        for name, bench in report["mqtt"].items():
+            print(f"  {name:<16} {bench['messages_per_second']} msg/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate and benchmark the thermostat control logic offline")
+    parser.add_argument("config", help="thermostat.yaml to simulate")
+    parser.add_argument("--hours", type=float, default=24.0, help="simulated duration")
+    parser.add_argument("--trace", help="replay zigbee2mqtt messages from a JSON lines trace")
+    parser.add_argument("--report-interval", type=float, default=60.0, help="seconds between simulated sensor reports")
+    parser.add_argument("--setpoint", type=float, help="setpoint for all rooms")
+    parser.add_argument("--initial-temperature", type=float, default=18.0)
+    parser.add_argument("--outdoor", type=float, default=5.0, help="outdoor temperature")
+    parser.add_argument("--time-constant", type=float, default=10.0, help="room cooldown time constant in hours")
+    parser.add_argument("--heat-rate", type=float, default=2.0, help="degrees per hour added while heating")
+    parser.add_argument("--cool-rate", type=float, default=2.0, help="degrees per hour removed while cooling")
+    parser.add_argument("--mqtt-messages", type=int, default=20000, help="messages for the MQTT handler benchmark, 0 to skip")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("simulate")
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    with open(args.config, "r") as f:
+        config = yaml.load(f, Loader=yaml.SafeLoader)
+
+    report = Simulation(logger, config, args).run()
+    if args.mqtt_messages:
+        report["mqtt"] = benchmark_mqtt(logger, config, args.mqtt_messages)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
@@ -0,0 +1,39 @@
+import copy
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# main.py is a script at the repository root, not an installed package
+sys.path.insert(0, ROOT)
+
+import main
+
+SAMPLE_CONFIG = main.load_config(os.path.join(ROOT, "thermostat.yaml"))
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("tests")
+
+
+@pytest.fixture
+def config():
+    # The sample configuration without hardware or files
+    config = copy.deepcopy(SAMPLE_CONFIG)
+    config["state"] = {}
+    del config["gpio_chip"]
+    return config
+
+
+@pytest.fixture
+def control_unit(logger, config):
+    relays = main.RelayBank(logger, None, main.unit_relay_gpios(config), False)
+    return main.ControlUnit(logger, config, relays)
+
+
+@pytest.fixture
+def thermostats(logger, config, control_unit):
+    return main.ThermostatRegistry(main.Thermostat(logger, control_unit, config, room) for room in config["rooms"])
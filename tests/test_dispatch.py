@@ -0,0 +1,29 @@
+import main
+
+TOPIC = "zigbee2mqtt/Temporary thermostat"
+PAYLOAD = b'{"local_temperature": 19.5, "current_heating_setpoint": 21}'
+
+
+def test_repeated_payload_is_skipped(logger, config, thermostats):
+    dispatch = main.Zigbee2MQTTDispatch(logger, config["mqtt"], thermostats)
+
+    assert dispatch.dispatch(TOPIC, PAYLOAD) == main.DISPATCH_DECODED
+    assert dispatch.dispatch(TOPIC, PAYLOAD) == main.DISPATCH_SKIPPED
+    assert thermostats.get("living_room").current_temp == 19.5
+
+
+def test_repeated_payload_reapplies_after_api_change(logger, config, thermostats):
+    dispatch = main.Zigbee2MQTTDispatch(logger, config["mqtt"], thermostats)
+    dispatch.dispatch(TOPIC, PAYLOAD)
+    thermostats.get("living_room").set_target_temperature(24)
+
+    assert dispatch.dispatch(TOPIC, PAYLOAD) == main.DISPATCH_DECODED
+    assert thermostats.get("living_room").target_temp == 21.0
+    assert dispatch.dispatch(TOPIC, PAYLOAD) == main.DISPATCH_SKIPPED
+
+
+def test_payload_without_mapped_fields(logger, config, thermostats):
+    dispatch = main.Zigbee2MQTTDispatch(logger, config["mqtt"], thermostats)
+
+    assert dispatch.dispatch(TOPIC, b'{"battery": 80}') == main.DISPATCH_SKIPPED
+    assert dispatch.dispatch("zigbee2mqtt/unknown", PAYLOAD) == main.DISPATCH_UNKNOWN
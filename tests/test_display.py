@@ -0,0 +1,40 @@
+import main
+
+DUMMY = {"driver": "dummy", "width": 128, "height": 64, "page_interval": 5}
+
+
+def test_startup_screen_is_drawn(logger, control_unit, thermostats):
+    display = main.Display(logger, control_unit, thermostats, DUMMY)
+
+    assert display.drawn[0] == "Starting up..."
+    assert display.device.image.getbbox() is not None
+
+
+def test_compose_and_render_only_changed_rows(logger, control_unit, thermostats):
+    display = main.Display(logger, control_unit, thermostats, DUMMY)
+    now = main.clock()
+
+    display.lines = display.compose(now)
+    assert display.lines[0].startswith(control_unit.name[:10])
+    assert "Living ro" in display.lines[1]
+    assert display.render()
+    assert not display.render()
+
+    thermostats.get("living_room").set_current_temperature(17.5)
+    display.lines = display.compose(now)
+    assert display.render()
+    assert "17.5" in display.drawn[1]
+
+
+def test_rooms_are_paged(logger, control_unit, thermostats):
+    display = main.Display(logger, control_unit, thermostats * 3, DUMMY)
+    now = main.clock()
+    per_page = display.rows - 1
+
+    first = display.compose(now)
+    second = display.compose(now + DUMMY["page_interval"])
+
+    assert display.page == 1
+    assert first[1:] != second[1:]
+    assert len(first) == len(second) == display.rows
+    assert per_page < len(thermostats) * 3
@@ -0,0 +1,58 @@
+import main
+
+TIERS = main.HistoryRecorder.default_tiers
+
+
+def record(history, start, count, interval=10):
+    for i in range(count):
+        history.record(start + i * interval, 20.0 + i * 0.01, 21.0, main.MODE_HEAT, 1.0)
+    return start + (count - 1) * interval
+
+
+def test_early_uptime_uses_raw_samples():
+    # 10 minutes after startup only the raw tier has a meaningful amount of data
+    history = main.RoomHistory(TIERS)
+    end = record(history, 1_000_000, 60)
+
+    result = history.query(end - 3600, end)
+
+    assert result["step"] == 10
+    assert len(result["t"]) == 60
+
+
+def test_empty_tier_is_never_selected():
+    history = main.RoomHistory(TIERS)
+    end = record(history, 1_000_005, 3)
+
+    tier = history.select_tier(end - 30 * 86400, end)
+
+    assert tier is history.tiers[0]
+
+
+def test_coarser_tier_used_when_it_reaches_further_back():
+    # Two hours of data: the raw tier only keeps the last hour
+    history = main.RoomHistory(TIERS)
+    end = record(history, 1_000_000, 720)
+
+    tier = history.select_tier(end - 7200, end)
+
+    assert tier.step == 60
+
+
+def test_requested_step_aggregates_finer_tier():
+    history = main.RoomHistory(TIERS)
+    end = record(history, 1_000_000, 60)
+
+    result = history.query(end - 600, end, step=60)
+
+    assert result["step"] == 60
+    assert 10 <= len(result["t"]) <= 11
+    assert all(mode == main.MODE_CODES.index(main.MODE_HEAT) for mode in result["mode"])
+
+
+def test_empty_history():
+    history = main.RoomHistory(TIERS)
+
+    result = history.query(0, 3600)
+
+    assert result["t"] == []
@@ -0,0 +1,68 @@
+import errno
+
+import main
+
+
+class FakeRequest:
+    def __init__(self, chip, offsets, values):
+        self.chip = chip
+        self.offsets = offsets
+        self.values = dict(values)
+
+    def set_values(self, values):
+        self.values.update(values)
+
+    def release(self):
+        self.chip.held -= self.offsets
+
+
+class FakeChip:
+    # Like the kernel, a line stays busy until the request holding it is released
+    def __init__(self):
+        self.held = set()
+
+    def line_offset_from_id(self, gpio):
+        return int(gpio.split()[0])
+
+    def request_lines(self, consumer, config, output_values):
+        offsets = {offset for lines in config for offset in lines}
+        if offsets & self.held:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        self.held |= offsets
+        return FakeRequest(self, offsets, output_values)
+
+
+def test_swapped_relays_follow_their_rooms(config, control_unit):
+    living_room = control_unit.room_index["living_room"]
+    bedroom = control_unit.room_index["bedroom"]
+    living_room.valve = living_room.valve_request = main.MODE_OPEN
+    control_unit.relays.set(living_room.gpio, True)
+    control_unit.relays.commit()
+    old_living_room, old_bedroom = living_room.gpio, bedroom.gpio
+
+    rooms = {room["id"]: room for room in config["rooms"]}
+    rooms["living_room"]["relay_gpio"], rooms["bedroom"]["relay_gpio"] = old_bedroom, old_living_room
+    control_unit.apply_config(config)
+    control_unit.relays.commit()
+
+    assert control_unit.relays.states[old_bedroom] is True
+    assert control_unit.relays.states[old_living_room] is False
+
+
+def test_dropped_line_can_be_added_back(logger, config):
+    chip = FakeChip()
+    gpios = main.unit_relay_gpios(config)
+    relays = main.RelayBank(logger, chip, gpios)
+    dropped = gpios[-1]
+
+    relays.remove_lines([dropped])
+    assert chip.line_offset_from_id(dropped) in chip.held
+    relays.add_lines(gpios)
+    relays.set(dropped, True)
+    relays.commit()
+
+    request = relays.requests[dropped]
+    assert request.values[chip.line_offset_from_id(dropped)] == main.Value.ACTIVE
+
+    relays.close()
+    assert not chip.held
@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+import main
+
+
+def test_transitions_are_sorted():
+    schedule = main.SetpointSchedule([["22:00", 18], ["06:30", "21.5"]])
+
+    assert schedule.to_list() == [["06:30", 21.5], ["22:00", 18.0]]
+    assert [schedule.active(minute) for minute in (0, 389, 390, 1319, 1320)] == [1, 1, 0, 0, 1]
+    assert schedule.minutes_until_next(0) == 390
+    assert schedule.minutes_until_next(1400) == 430
+
+
+@pytest.mark.parametrize("transitions", [
+    [],
+    [["24:00", 20]],
+    [["00:75", 20]],
+    [["-1:30", 20]],
+    [["6", 20]],
+    [["06:30:00", 20]],
+    [["06:30", 20], ["06:30", 18]],
+    [["06:30", "nan"]],
+    [["06:30", "inf"]],
+    [["06:30", "warm"]],
+])
+def test_invalid_schedules_are_rejected(transitions):
+    with pytest.raises(ValueError):
+        main.SetpointSchedule(transitions)
+
+
+@pytest.fixture
+def utc():
+    tz = os.environ.get("TZ")
+    os.environ["TZ"] = "UTC"
+    time.tzset()
+    yield
+    if tz is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = tz
+    time.tzset()
+
+
+def test_new_year_does_not_repeat_a_transition(logger, thermostats, utc):
+    thermostat = thermostats.get("living_room")
+    thermostat.set_schedule(main.SetpointSchedule([["06:00", 21], ["22:00", 18]]))
+    runner = main.ScheduleRunner(logger, thermostats)
+
+    runner.apply(1767222000)  # 2025-12-31 23:00 UTC
+    assert thermostat.target_temp == 18.0
+    thermostat.set_target_temperature(20)
+
+    timeout = runner.apply(1767227400)  # 2026-01-01 00:30 UTC
+    assert thermostat.target_temp == 20.0
+    assert timeout == 5.5 * 3600
+
+    runner.apply(1767247200)  # 06:00
+    assert thermostat.target_temp == 21.0
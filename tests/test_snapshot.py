@@ -0,0 +1,84 @@
+import main
+
+
+def test_round_trip(logger, config, control_unit, thermostats, tmp_path):
+    path = tmp_path / "state.bin"
+    state_config = {"path": str(path)}
+    living_room = thermostats.get("living_room")
+    living_room.set_target_temperature(22.5)
+    living_room.set_current_temperature(18.25)
+    control_unit.room_index["living_room"].valve = main.MODE_OPEN
+    state_snapshot = main.StateSnapshot(logger, control_unit, thermostats, state_config)
+    state_snapshot.save()
+    state_snapshot.writer.join()
+
+    snapshot = main.StateSnapshot.load(logger, state_config)
+
+    assert snapshot["fresh"]
+    assert set(snapshot["rooms"]) == {room["id"] for room in config["rooms"]}
+    saved = snapshot["rooms"]["living_room"]
+    assert (saved["target_temp"], saved["current_temp"], saved["valve"]) == (22.5, 18.25, main.MODE_OPEN)
+
+    restored = main.ThermostatRegistry(main.Thermostat(logger, control_unit, config, room) for room in config["rooms"])
+    main.StateSnapshot(logger, control_unit, restored, state_config).restore(snapshot)
+    assert restored.get("living_room").target_temp == 22.5
+    assert restored.get("living_room").current_temp == 18.25
+    assert main.StateSnapshot.relay_states(snapshot, config)[config["rooms"][0]["relay_gpio"]]
+
+
+def test_restore_uses_the_configured_limits(logger, config, control_unit, thermostats, tmp_path):
+    state_config = {"path": str(tmp_path / "state.bin")}
+    thermostats.get("living_room").set_target_temperature(27)
+    state_snapshot = main.StateSnapshot(logger, control_unit, thermostats, state_config)
+    state_snapshot.save()
+    state_snapshot.writer.join()
+
+    config["control"]["max_temperature"] = 22
+    restored = main.ThermostatRegistry(main.Thermostat(logger, control_unit, config, room) for room in config["rooms"])
+    main.StateSnapshot(logger, control_unit, restored, state_config).restore(main.StateSnapshot.load(logger, state_config))
+
+    living_room = restored.get("living_room")
+    assert (living_room.max_temp, living_room.target_temp) == (22, 22)
+
+
+def test_saves_during_a_write_keep_the_newest_state(logger, control_unit, thermostats, tmp_path):
+    state_config = {"path": str(tmp_path / "state.bin")}
+    state_snapshot = main.StateSnapshot(logger, control_unit, thermostats, state_config)
+    living_room = thermostats.get("living_room")
+    for setpoint in (19, 20, 21):
+        living_room.set_target_temperature(setpoint)
+        state_snapshot.save()
+    state_snapshot.writer.join()
+
+    assert main.StateSnapshot.load(logger, state_config)["rooms"]["living_room"]["target_temp"] == 21
+
+
+def test_corrupt_room_id_is_ignored(logger, tmp_path):
+    # A multibyte character cut in half must not crash startup
+    path = tmp_path / "state.bin"
+    data = main.StateSnapshot.header.pack(main.StateSnapshot.magic, 0, 0, 0.0, 0.0, 1)
+    data += main.StateSnapshot.room.pack("ä".encode()[:1], 0, 0, 0.0, 20.0, 20.0)
+    path.write_bytes(data)
+
+    assert main.StateSnapshot.load(logger, {"path": str(path)}) is None
+
+
+def test_truncated_file_is_ignored(logger, tmp_path):
+    path = tmp_path / "state.bin"
+    path.write_bytes(main.StateSnapshot.magic + b"\0" * 4)
+
+    assert main.StateSnapshot.load(logger, {"path": str(path)}) is None
+
+
+def test_long_room_ids_are_rejected(config):
+    config["rooms"][0]["id"] = "x" * 33
+
+    errors = main.validate_config(config)
+
+    assert any("longer than 32 bytes" in error for error in errors)
+
+
+def test_multibyte_room_id_limit(config):
+    config["rooms"][0]["id"] = "ö" * 17
+
+    assert any("longer than 32 bytes" in error for error in main.validate_config(config))
@@ -0,0 +1,107 @@
+import pytest
+
+import main
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main, "clock", clock)
+    return clock
+
+
+@pytest.fixture
+def config(config):
+    config["control"].update(stale_after=60, stale_action=main.STALE_OFF_TEMPERATURE, stale_max_heat=600)
+    return config
+
+
+@pytest.fixture
+def monitor(logger, clock, thermostats):
+    changed = []
+    for thermostat in thermostats:
+        thermostat.on_change = changed.append
+    monitor = main.StaleSensorMonitor(logger, thermostats)
+    monitor.changed = changed
+    return monitor
+
+
+def test_rooms_without_readings_turn_stale(clock, thermostats, monitor):
+    assert monitor.expire(clock.now) == 60
+    assert not any(thermostat.stale for thermostat in thermostats)
+
+    clock.now += 60
+    monitor.expire(clock.now)
+    assert all(thermostat.stale for thermostat in thermostats)
+    assert set(monitor.changed) == set(thermostats)
+
+
+def test_a_reading_pushes_the_expiry_back(clock, thermostats, monitor):
+    living_room = thermostats.get("living_room")
+    clock.now += 30
+    living_room.touch("current_temp", clock.now)
+
+    clock.now += 30
+    assert monitor.expire(clock.now) == 30
+    assert not living_room.stale
+    assert thermostats.get("bedroom").stale
+
+    clock.now += 30
+    monitor.expire(clock.now)
+    assert living_room.stale
+
+
+def test_readings_resuming_make_the_room_fresh_again(clock, thermostats, monitor):
+    living_room = thermostats.get("living_room")
+    clock.now += 60
+    monitor.expire(clock.now)
+
+    living_room.touch("current_temp", clock.now)
+    assert not living_room.stale
+
+    clock.now += 59
+    monitor.expire(clock.now)
+    assert not living_room.stale
+    clock.now += 1
+    monitor.expire(clock.now)
+    assert living_room.stale
+
+
+def test_rooms_without_stale_after_are_not_watched(logger, config, clock, thermostats, monitor):
+    clock.now += 60
+    monitor.expire(clock.now)
+
+    config["control"]["stale_after"] = 0
+    for thermostat in thermostats:
+        thermostat.configure(config, thermostat.room)
+    monitor.set_thermostats(thermostats)
+
+    assert not any(thermostat.stale for thermostat in thermostats)
+    assert monitor.expire(clock.now) is None
+
+
+def test_off_temperature_heating_is_bounded(clock, thermostats, monitor):
+    living_room = thermostats.get("living_room")
+    living_room.current_temp = living_room.off_temperature - 1
+    clock.now += 60
+    monitor.expire(clock.now)
+    monitor.changed.clear()
+
+    living_room.control()
+    assert living_room.current_mode == main.MODE_HEAT
+
+    assert monitor.expire(clock.now + 599) == 1
+    clock.now += 600
+    monitor.expire(clock.now)
+    assert living_room in monitor.changed
+    living_room.control()
+    assert living_room.current_mode == main.MODE_OFF
+    assert monitor.expire(clock.now) is None
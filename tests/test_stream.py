@@ -0,0 +1,27 @@
+import main
+
+
+def test_patch_only_carries_the_changed_room(logger, control_unit, thermostats):
+    stream = main.StateStream(logger, control_unit, thermostats)
+    queue = stream.subscribe()
+
+    thermostats.get("living_room").set_current_temperature(17.5)
+    stream.update()
+
+    assert queue.get_nowait() == {"thermostats": {"living_room": {"temperature": 17.5}}}
+    assert stream.snapshot["thermostats"]["living_room"] == thermostats.get("living_room").to_dict()
+    assert stream.snapshot["device"] == control_unit.get_mqtt_discovery_message()
+
+    stream.update()
+    assert queue.empty()
+
+
+def test_removed_rooms_are_patched_out(logger, control_unit, thermostats):
+    stream = main.StateStream(logger, control_unit, thermostats)
+    queue = stream.subscribe()
+
+    thermostats.replace([thermostat for thermostat in thermostats if thermostat.id != "bedroom"])
+    stream.update()
+
+    assert queue.get_nowait() == {"thermostats": {"bedroom": None}}
+    assert "bedroom" not in stream.snapshot["thermostats"]
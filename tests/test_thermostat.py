@@ -0,0 +1,29 @@
+import copy
+
+import main
+
+
+def test_reload_applies_temperature_limits(config, thermostats):
+    thermostat = thermostats.get("living_room")
+    thermostat.set_target_temperature(27)
+    new_config = copy.deepcopy(config)
+    new_config["control"]["max_temperature"] = 25.0
+    new_config["control"]["min_temperature"] = 18.0
+
+    thermostat.apply_config(new_config, new_config["rooms"][0])
+
+    assert (thermostat.min_temp, thermostat.max_temp) == (18.0, 25.0)
+    assert thermostat.target_temp == 25.0
+
+
+def test_reload_keeps_reported_limits_when_unchanged(config, thermostats):
+    thermostat = thermostats.get("living_room")
+    thermostat.set_max_temp(30)
+
+    thermostat.apply_config(copy.deepcopy(config), copy.deepcopy(config["rooms"][0]))
+
+    assert thermostat.max_temp == 30.0
+
+
+def test_initial_temperature_needs_restart():
+    assert "initial_temperature" in main.ConfigReloader.restart_control_keys
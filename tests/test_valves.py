@@ -0,0 +1,100 @@
+import main
+
+
+def setup(control_unit, **control):
+    control_unit.configure(dict(control_unit.config, **control))
+    control_unit.target_mode = main.MODE_HEAT
+    control_unit.next_deadline = None
+    # Whole seconds, so deadlines computed from it compare exactly
+    return float(int(main.clock()) + 1000)
+
+
+def request(control_unit, state, *room_ids):
+    rooms = [control_unit.room_index[room_id] for room_id in room_ids]
+    for room in rooms:
+        room.valve_request = state
+    return rooms
+
+
+def test_min_cycle_postpones(control_unit):
+    now = setup(control_unit)
+    room = control_unit.room_index["living_room"]
+    room.valve_last_changed = now - 1
+
+    control_unit.plan_valves(request(control_unit, main.MODE_OPEN, "living_room"), now)
+
+    assert room.valve == main.MODE_CLOSED
+    assert control_unit.next_deadline == now - 1 + control_unit.valve_min_cycle_duration
+    assert room in control_unit.valve_dirty
+
+
+def test_openings_are_staggered_longest_waiting_first(control_unit):
+    now = setup(control_unit, valve_stagger=30)
+    control_unit.room_index["living_room"].valve_last_changed = now - 100
+    control_unit.room_index["bedroom"].valve_last_changed = now - 500
+
+    control_unit.plan_valves(request(control_unit, main.MODE_OPEN, "living_room", "bedroom"), now)
+
+    assert control_unit.room_index["bedroom"].valve == main.MODE_OPEN
+    assert control_unit.room_index["living_room"].valve == main.MODE_CLOSED
+    assert control_unit.next_deadline == now + 30
+
+    control_unit.plan_valves(request(control_unit, main.MODE_OPEN, "living_room"), now + 30)
+    assert control_unit.room_index["living_room"].valve == main.MODE_OPEN
+
+
+def test_switch_budget(control_unit):
+    now = setup(control_unit, valve_max_switches_per_hour=2, valve_min_cycle_duration=0)
+    room = control_unit.room_index["living_room"]
+
+    for i, state in enumerate((main.MODE_OPEN, main.MODE_CLOSED, main.MODE_OPEN)):
+        control_unit.plan_valves(request(control_unit, state, "living_room"), now + i)
+
+    assert room.valve == main.MODE_CLOSED
+    assert control_unit.next_deadline == now + 3600
+
+    control_unit.plan_valves(request(control_unit, main.MODE_OPEN, "living_room"), now + 3600)
+    assert room.valve == main.MODE_OPEN
+
+
+def test_bypass_room_opens_when_everything_closes(control_unit):
+    now = setup(control_unit, bypass_room="bathroom")
+
+    control_unit.plan_valves(request(control_unit, main.MODE_CLOSED, *control_unit.room_index), now)
+
+    assert control_unit.room_index["bathroom"].valve == main.MODE_OPEN
+
+
+def test_bypass_hold_is_counted_once(control_unit):
+    now = setup(control_unit, bypass_room="bathroom")
+    bypass = control_unit.room_index["bathroom"]
+    room = control_unit.room_index["living_room"]
+    room.valve = main.MODE_OPEN
+    # The bypass valve itself cannot switch yet, so the last open valve is held instead
+    bypass.valve_last_changed = now
+    counter = control_unit.deferral_counters["bypass"]
+    before = counter.value
+
+    for tick in range(5):
+        control_unit.plan_valves(request(control_unit, main.MODE_CLOSED, "living_room"), now + tick)
+
+    assert room.valve == main.MODE_OPEN
+    assert counter.value == before + 1
+
+
+def test_bypass_waiting_for_its_min_cycle_sets_a_deadline(control_unit):
+    now = setup(control_unit, bypass_room="bathroom")
+    bypass = control_unit.room_index["bathroom"]
+    bypass.valve_last_changed = now
+    counter = control_unit.deferral_counters["bypass"]
+    before = counter.value
+
+    for tick in range(3):
+        control_unit.plan_valves(set(), now + tick)
+
+    assert bypass.valve == main.MODE_CLOSED
+    assert control_unit.next_deadline == now + control_unit.valve_min_cycle_duration
+    assert counter.value == before + 1
+
+    control_unit.plan_valves(set(), control_unit.next_deadline)
+    assert bypass.valve == main.MODE_OPEN
@@ -0,0 +1,73 @@
+import pytest
+
+import main
+import webapi
+
+
+@pytest.fixture
+def controller(logger, config):
+    controller = main.Controller(logger, config)
+    controller.state_stream = main.StateStream(logger, controller.control_unit, controller.thermostats)
+    return controller
+
+
+@pytest.fixture
+def client(logger, controller):
+    app = webapi.create_app([controller], main.ScheduleRunner(logger, controller.thermostats), main.METRICS)
+    return app.test_client()
+
+
+@pytest.mark.parametrize("value", ["nan", "inf", "-inf", "warm"])
+def test_non_finite_setpoints_are_rejected(client, controller, value):
+    thermostat = controller.thermostats.get("living_room")
+    before = thermostat.target_temp
+
+    assert client.post("/thermostats/", json={"living_room": value}).status_code == 400
+    assert client.post("/thermostats/living_room", json={"set": value}).status_code == 400
+    assert thermostat.target_temp == before
+
+
+def test_single_room_setpoint_is_clamped(client, config, controller):
+    response = client.post("/thermostats/living_room", json={"set": 99})
+
+    assert response.status_code == 200
+    assert controller.thermostats.get("living_room").target_temp == float(config["control"]["max_temperature"])
+
+
+def units_config(config, **second_control):
+    second = {"control": dict({"id": "first_floor"}, **second_control), "gpio_chip": "/dev/gpiochip1"}
+    config["units"] = [{"control": {"id": "ground_floor"}}, second]
+    return config
+
+
+def test_first_unit_is_also_served_at_the_root(logger, config):
+    controllers = [main.Controller(logger, unit_config, open_gpio=False) for unit_config in main.unit_configs(units_config(config))]
+    for controller in controllers:
+        controller.state_stream = main.StateStream(logger, controller.control_unit, controller.thermostats)
+    thermostats = [thermostat for controller in controllers for thermostat in controller.thermostats]
+    client = webapi.create_app(controllers, main.ScheduleRunner(logger, thermostats), main.METRICS).test_client()
+
+    assert set(client.get("/units/").get_json()) == {"ground_floor", "first_floor"}
+    assert client.get("/thermostats/").get_json() == client.get("/units/ground_floor/thermostats/").get_json()
+    setpoint = controllers[0].thermostats.get("living_room").target_temp + 1
+    assert client.post("/thermostats/living_room", json={"set": setpoint}).status_code == 200
+    assert controllers[0].thermostats.get("living_room").target_temp == setpoint
+    assert controllers[1].thermostats.get("living_room").target_temp != setpoint
+
+
+def test_units_must_share_the_debounce(config):
+    assert main.validate_config(units_config(config)) == []
+    errors = main.validate_config(units_config(config, debounce=1))
+    assert errors == ["units[1]: control debounce differs from the first unit, it is shared by all units"]
+
+
+def test_units_must_not_share_relay_lines(config):
+    config["gpio_chip"] = "/dev/gpiochip0"
+    units_config(config)
+    del config["units"][1]["gpio_chip"]
+
+    errors = main.validate_config(config)
+
+    heat_relay = config["control"]["heat_relay_gpio"]
+    assert f"units[1]: relay {heat_relay} on /dev/gpiochip0 is also used by units[0]" in errors
+    assert len(errors) == len(main.unit_relay_gpios(config))
@@ -26,63 +26,75 @@ function App() {
 		background-color: #70B8FF;
 	}
 `
-  async function loadControlUnit() {
-    console.log("Loading control unit information")
-    try {
-      const res = await fetch(`/api/device/`)
-      const controlUnit = await res.json()
-      setDevice(controlUnit)
-    } catch (err) {
-      console.error(err)
+  function mergePatch(target, patch) {
+    if (patch === null || typeof patch !== 'object' || Array.isArray(patch)) {
+      return patch
     }
+    let result = (target !== null && typeof target === 'object' && !Array.isArray(target)) ? { ...target } : {}
+    Object.entries(patch).forEach(([k, v]) => {
+      if (v === null) {
+        delete result[k]
+      } else {
+        result[k] = mergePatch(result[k], v)
+      }
+    })
+    return result
   }
 
-  async function loadThermostats() {
-    console.log("Loading thermostats")
-    try {
-      const res = await fetch(`/api/thermostats/`)
-      const stats = await res.json()
-      let sp = {}
-      Object.keys(stats).forEach((k) => {
-        sp[k] = stats[k].setpoint_temperature
+  function applySetpoints(thermostats, changed) {
+    // Only rooms whose setpoint came in are updated, so a dial being dragged is left alone
+    setSetpoints((current) => {
+      let sp = { ...current }
+      Object.keys(changed).forEach((k) => {
+        if (thermostats[k] === undefined) {
+          delete sp[k]
+        } else if (changed[k] === null || changed[k].setpoint_temperature !== undefined) {
+          sp[k] = thermostats[k].setpoint_temperature
+        }
       })
-      setSetpoints(sp)
-      setThermostats(stats)
-    } catch (err) {
-      console.error(err)
-    }
+      return sp
+    })
   }
 
+  function applySnapshot(snapshot) {
+    setDevice(snapshot.device)
+    setThermostats(snapshot.thermostats)
 
-  async function loadControlUnitStatus() {
-    console.log("Loading control unit status")
-    try {
-      const res = await fetch(`/api/status/`)
-      const controlUnitStatus = await res.json()
-      setStatus(controlUnitStatus)
-      console.log(controlUnitStatus)
-      if (controlUnitStatus.cold) {
-        setMode("cool")
-      } else if (controlUnitStatus.heat) {
-        setMode("heat")
-      } else {
-        setMode("off")
-      }
-    } catch (err) {
-      console.error(err)
+    setStatus(snapshot.status)
+    if (snapshot.status.cold) {
+      setMode("cool")
+    } else if (snapshot.status.heat) {
+      setMode("heat")
+    } else {
+      setMode("off")
     }
-    console.log("Unit mode: " + mode)
   }
 
   useEffect(() => {
-    loadControlUnit()
-    loadControlUnitStatus()
-    loadThermostats()
-  }, [])
-
-  useEffect(() => {
-    let interval = setInterval(() => loadControlUnitStatus(), 5000)
-    return () => clearInterval(interval)
+    // The server sends one snapshot on connect and JSON merge patches after that
+    let snapshot = null
+    const events = new EventSource(`/api/events/`)
+    events.addEventListener("snapshot", (e) => {
+      console.log("Received state snapshot")
+      snapshot = JSON.parse(e.data)
+      setSetpoints({})
+      applySetpoints(snapshot.thermostats, snapshot.thermostats)
+      applySnapshot(snapshot)
+    })
+    events.addEventListener("diff", (e) => {
+      if (snapshot) {
+        const patch = JSON.parse(e.data)
+        snapshot = mergePatch(snapshot, patch)
+        if (patch.thermostats) {
+          applySetpoints(snapshot.thermostats, patch.thermostats)
+        }
+        applySnapshot(snapshot)
+      }
+    })
+    events.onerror = (err) => {
+      console.error(err)
+    }
+    return () => events.close()
   }, [])
 
   const changeSetpoint = (tstat, sp) => {
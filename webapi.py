@@ -0,0 +1,248 @@
+# HTTP API, imported only once control and MQTT are running so the web stack
+# does not delay startup
+import json
+import time
+import zlib
+import gevent.queue
+from flask import Blueprint, Flask, request, jsonify, Response, stream_with_context
+from flask_classful import FlaskView, route
+from setpoints import SetpointSchedule, parse_setpoint
+
+def add_cors(response):
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Methods"] = "*"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    return response
+
+def cached_response(payload, etag):
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(payload, mimetype="application/json")
+    resp.set_etag(etag)
+    return add_cors(resp)
+
+def api_error(message, status=400):
+    resp = jsonify({"error": message})
+    resp.status_code = status
+    return add_cors(resp)
+
+class ThermostatAPI(FlaskView):
+    def __init__(self, args):
+       self._thermostats, self._schedules = args
+
+    def index(self):
+        # Stitched together from the per-thermostat cached payloads
+        parts = []
+        for thermostat in self._thermostats:
+            parts.append(json.dumps(thermostat.id).encode() + b": " + thermostat.dict_cache.get(thermostat.state_version))
+        payload = b"{" + b", ".join(parts) + b"}"
+        return cached_response(payload, "%08x" % (zlib.crc32(payload)))
+
+    @route('/', methods=['POST'])
+    def bulk_set(self):
+        # {"room": 21.5, "other_room": {"set": 19, "schedule": [["06:30", 21], ["22:00", 18]]}}
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict):
+            return api_error("expected a JSON object of room id to setpoint")
+
+        # Everything is validated before anything is applied
+        updates = []
+        for room_id, change in changes.items():
+            thermostat = self._thermostats.get(room_id)
+            if thermostat is None:
+                return api_error(f"unknown room: {room_id}", 404)
+            if not isinstance(change, dict):
+                change = {"set": change}
+            try:
+                target_temp = parse_setpoint(change["set"]) if change.get("set") is not None else None
+                schedule = SetpointSchedule(change["schedule"]) if change.get("schedule") else None
+            except (TypeError, ValueError) as e:
+                return api_error(f"{room_id}: {e}")
+            updates.append((thermostat, target_temp, schedule, "schedule" in change))
+
+        # Applied without yielding to the hub, so the scheduler sees all of it in one evaluation
+        for thermostat, target_temp, schedule, replace_schedule in updates:
+            if replace_schedule:
+                thermostat.set_schedule(schedule)
+        # A new schedule takes effect right away, an explicit setpoint overrides it until the next transition
+        self._schedules.apply(time.time())
+        self._schedules.wakeup.set()
+        for thermostat, target_temp, schedule, replace_schedule in updates:
+            if target_temp is not None:
+                thermostat.set_target_temperature(target_temp)
+
+        resp = jsonify({thermostat.id: thermostat.to_dict() for thermostat, _, _, _ in updates})
+        return add_cors(resp)
+    
+    @route('/<id>', methods=['GET', 'OPTIONS'])
+    def thermostat(self, id):
+        thermostat = self._thermostats.get(id)
+        if thermostat:
+            payload = thermostat.dict_cache.get(thermostat.state_version)
+            return cached_response(payload, thermostat.dict_cache.etag)
+        resp = jsonify({})
+        return add_cors(resp)
+
+    @route('/<id>', methods=['POST'])
+    def thermostat_set(self, id):
+        ret = {}
+        thermostat = self._thermostats.get(id)
+        if thermostat:
+            value = (request.get_json(silent=True) or {}).get('set')
+            if value is not None:
+                try:
+                    target_temp = parse_setpoint(value)
+                except (TypeError, ValueError) as e:
+                    return api_error(f"{id}: {e}")
+                # Clamped to the room's limits like the bulk update
+                thermostat.set_target_temperature(target_temp)
+            ret = thermostat.to_dict()
+        resp = jsonify(ret)
+        return add_cors(resp)
+
+    @route('/<id>/schedule', methods=['GET'])
+    def schedule(self, id):
+        ret = []
+        thermostat = self._thermostats.get(id)
+        if thermostat and thermostat.schedule:
+            ret = thermostat.schedule.to_list()
+        resp = jsonify(ret)
+        return add_cors(resp)
+
+    @route('/<id>/freshness', methods=['GET'])
+    def freshness(self, id):
+        thermostat = self._thermostats.get(id)
+        if thermostat is None:
+            return api_error(f"unknown room: {id}", 404)
+        return add_cors(jsonify(thermostat.freshness()))
+
+    @route('/<id>/history', methods=['GET'])
+    def history(self, id):
+        ret = {}
+        thermostat = self._thermostats.get(id)
+        if thermostat and thermostat.history:
+            end = request.args.get('to', time.time(), type=float)
+            start = request.args.get('from', end - 3600, type=float)
+            step = request.args.get('step', 0, type=float)
+            ret = thermostat.history.query(start, end, step)
+        resp = jsonify(ret)
+        return add_cors(resp)
+
+class MetricsAPI(FlaskView):
+    def __init__(self, args):
+        self._metrics = args
+
+    def index(self):
+        return Response(self._metrics.render(), mimetype="text/plain; version=0.0.4")
+
+class WebAPI(FlaskView):
+    help_message = """
+    <h1>API definition</h1>
+    
+    <pre>
+    GET /thermostats/
+    GET /status/
+    GET /device/
+    GET /events/  (text/event-stream: snapshot, then diffs as JSON merge patches)
+    GET /metrics  (Prometheus text format)
+    
+    GET /thermostats/<id>/history?from=&to=&step=
+    (columnar: t, temperature, setpoint, mode as index into modes, valve open fraction)
+
+    GET /thermostats/<id>/schedule
+    (daily transitions: [["06:30", 21.0], ["22:00", 18.0]])
+
+    GET /thermostats/<id>/freshness
+    (stale flag and seconds since each sensor field was last received)
+
+    POST /thermostats/<id>/
+    {"set":22.5}
+
+    POST /thermostats/  (all rooms applied together, or none on error)
+    {"living_room":21.5, "bedroom":{"set":19, "schedule":[["06:30", 21], ["22:00", 18]]}}
+
+    With several control units configured every path above except /metrics is also under
+    /units/<id>/, /units/ lists them and the paths above are the first unit
+    </pre>
+    """
+    def __init__(self, args):
+        self._control_unit = args
+
+    def index(self):
+        resp = Response(self.help_message)
+        return add_cors(resp)
+
+    def device(self):
+        cache = self._control_unit.discovery_cache
+        payload = cache.get(self._control_unit.discovery_version)
+        return cached_response(payload, cache.etag)
+
+    def status(self):
+        cache = self._control_unit.dict_cache
+        payload = cache.get(self._control_unit.state_version)
+        return cached_response(payload, cache.etag)
+
+class EventsAPI(FlaskView):
+    keepalive_interval = 15
+
+    def __init__(self, args):
+        self._stream = args
+
+    def index(self):
+        stream = self._stream
+        queue = stream.subscribe()
+
+        def events():
+            try:
+                yield "event: snapshot\ndata: %s\n\n" % (json.dumps(stream.snapshot))
+                while True:
+                    try:
+                        patch = queue.get(timeout=self.keepalive_interval)
+                    except gevent.queue.Empty:
+                        yield ": keepalive\n\n"
+                        continue
+                    if patch is None:
+                        yield "event: snapshot\ndata: %s\n\n" % (json.dumps(stream.snapshot))
+                    else:
+                        yield "event: diff\ndata: %s\n\n" % (json.dumps(patch))
+            finally:
+                stream.unsubscribe(queue)
+
+        resp = Response(stream_with_context(events()), mimetype="text/event-stream")
+        resp.headers["Cache-Control"] = "no-cache"
+        # Keep nginx from buffering the stream
+        resp.headers["X-Accel-Buffering"] = "no"
+        return add_cors(resp)
+
+class UnitsAPI(FlaskView):
+    def __init__(self, args):
+        self._controllers = args
+
+    def index(self):
+        units = {}
+        for controller in self._controllers:
+            units[controller.id] = {"name": controller.config["control"]["name"], "url": f"/units/{controller.id}/"}
+        return add_cors(jsonify(units))
+
+def register_unit(app, controller, schedule_runner):
+    WebAPI.register(app, route_base="/", init_argument=(controller.control_unit))
+    ThermostatAPI.register(app, route_base="/thermostats", init_argument=(controller.thermostats, schedule_runner))
+    EventsAPI.register(app, route_base="/events", init_argument=(controller.state_stream))
+
+def create_app(controllers, schedule_runner, metrics):
+    app = Flask(__name__)
+    if len(controllers) == 1 and not controllers[0].config.get("namespace"):
+        register_unit(app, controllers[0], schedule_runner)
+    else:
+        # The first unit stays at the root as well, that is where the bundled UI looks
+        register_unit(app, controllers[0], schedule_runner)
+        UnitsAPI.register(app, route_base="/units", init_argument=(controllers))
+        # A blueprint per unit keeps the endpoint names of the views apart
+        for controller in controllers:
+            blueprint = Blueprint(controller.id, __name__, url_prefix=f"/units/{controller.id}")
+            register_unit(blueprint, controller, schedule_runner)
+            app.register_blueprint(blueprint)
+    # Exactly /metrics, which is what Prometheus scrapes by default
+    MetricsAPI.register(app, route_base="/metrics", trailing_slash=False, init_argument=(metrics))
+    return app